@@ -1,11 +1,16 @@
+# Keeps file indexes in memory between searches; the bindings below fall
+# back to a normal search when no server is running.
+#
+#   qf --serve &
+
 # To add ctrl+f as a qf hotkey.
 
-bind '"\C-f": "qf\n"'
-bind '"\C-e": "cd `qf -d`\n"'
+bind '"\C-f": "qf --remote\n"'
+bind '"\C-e": "cd `qf --remote -d`\n"'
 
 # To enable a new bash command, 'qcd', for quickly cd-ing to a directory.
 function qcd() {
-    _OFILE=$(qf -d -o -f "{0}")
+    _OFILE=$(qf --remote -d -o -f "{0}")
     if [ -n "$_OFILE" ]; then
         cd $_OFILE
     fi
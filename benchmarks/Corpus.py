@@ -0,0 +1,138 @@
+import os, json, random, shutil
+
+WORDS = ['src', 'lib', 'core', 'util', 'test', 'main', 'io', 'net', 'http', 'json',
+        'parse', 'render', 'order', 'search', 'index', 'cache', 'pool', 'worker',
+        'query', 'rank', 'source', 'config', 'model', 'view', 'api', 'client',
+        'server', 'event', 'stream', 'buffer', 'quick', 'find', 'file', 'tags']
+
+EXTENSIONS = ['py', 'c', 'h', 'js', 'md', 'txt', 'go', 'rs']
+
+STAMP = '.quickfind-corpus'
+
+class Corpus(object):
+    """
+    A synthetic corpus on disk.  It's built from `seed` and the given sizes,
+    so every run with the same parameters sees the same data, and is only
+    regenerated when the parameters change.
+    """
+
+    def __init__(self, root, files=50000, tags=200000, lines=1000000, seed=0):
+        self.root = os.path.abspath(root)
+        self.params = {'files': files, 'tags': tags, 'lines': lines, 'seed': seed}
+        self.tree = os.path.join(self.root, 'tree')
+        self.tags = os.path.join(self.root, 'tags')
+        self.lines = os.path.join(self.root, 'lines.txt')
+
+    def stamp(self):
+        try:
+            with open(os.path.join(self.root, STAMP)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def ensure(self):
+        "Generates the corpus unless it's already there"
+        if self.stamp() == self.params:
+            return self
+
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+
+        seed = self.params['seed']
+        make_tree(self.tree, self.params['files'], seed)
+        make_tags(self.tags, self.params['tags'], seed)
+        make_lines(self.lines, self.params['lines'], seed)
+
+        with open(os.path.join(self.root, STAMP), 'w') as f:
+            json.dump(self.params, f)
+
+        return self
+
+def file_name(rng):
+    return '%s_%s%d.%s' % (rng.choice(WORDS), rng.choice(WORDS), rng.randint(0, 99),
+            rng.choice(EXTENSIONS))
+
+def make_tree(root, files, seed=0, depth=7, per_dir=20):
+    """
+    A tree of about `files` listed files, `per_dir` to a directory on
+    average, nested up to `depth` deep.  A tenth of the directories also
+    hold a build directory and object files that the root .gitignore
+    excludes, and some have their own .gitignore for temporary files.
+    """
+    rng = random.Random(seed)
+    dirs = ['']
+    seen = set(dirs)
+    while len(dirs) < max(1, files // per_dir):
+        parent = rng.choice(dirs)
+        if parent.count(os.sep) >= depth:
+            continue
+
+        name = os.path.join(parent, rng.choice(WORDS) + str(rng.randint(0, 9)))
+        if name not in seen:
+            seen.add(name)
+            dirs.append(name)
+
+    for d in dirs:
+        os.makedirs(os.path.join(root, d))
+
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write('build\n*.o\n/dist\n')
+
+    def touch(path):
+        open(path, 'w').close()
+
+    for _ in range(files):
+        touch(os.path.join(root, rng.choice(dirs), file_name(rng)))
+
+    for d in dirs:
+        full = os.path.join(root, d)
+        roll = rng.random()
+        if roll < 0.1:
+            build = os.path.join(full, 'build')
+            if not os.path.isdir(build):
+                os.mkdir(build)
+            for i in range(per_dir):
+                touch(os.path.join(build, 'out%d.o' % i))
+        elif roll < 0.15:
+            with open(os.path.join(full, '.gitignore'), 'w') as f:
+                f.write('*.tmp\n')
+            for i in range(3):
+                touch(os.path.join(full, 'scratch%d.tmp' % i))
+
+    os.mkdir(os.path.join(root, 'dist'))
+    for i in range(per_dir):
+        touch(os.path.join(root, 'dist', 'bundle%d.js' % i))
+
+def make_tags(path, tags, seed=0):
+    "A sorted tags file in the extended format of `tags` functions and classes"
+    rng = random.Random(seed)
+    files = [os.path.join(rng.choice(WORDS), rng.choice(WORDS), file_name(rng))
+            for _ in range(max(1, tags // 50))]
+
+    entries = []
+    for i in range(tags):
+        name = '%s_%s_%d' % (rng.choice(WORDS), rng.choice(WORDS), i)
+        if rng.random() < 0.8:
+            kind, pattern = 'f', '/^def %s(self):$/' % name
+        else:
+            kind, pattern = 'c', '/^class %s(object):$/' % name
+
+        entries.append((name, rng.choice(files), pattern, kind, rng.randint(1, 5000)))
+
+    entries.sort()
+    with open(path, 'w') as f:
+        f.write('!_TAG_FILE_FORMAT\t2\t/extended format/\n')
+        f.write('!_TAG_FILE_SORTED\t1\t/0=unsorted, 1=sorted, 2=foldcase/\n')
+        for name, filename, pattern, kind, line in entries:
+            f.write('%s\t%s\t%s;"\t%s\tline:%d\n' % (name, filename, pattern, kind, line))
+
+def make_lines(path, lines, seed=0):
+    "`lines` log-like lines, as might be piped into qf"
+    rng = random.Random(seed)
+    levels = ['DEBUG', 'INFO', 'INFO', 'INFO', 'WARN', 'ERROR']
+    with open(path, 'w') as f:
+        for i in range(lines):
+            f.write('%05d %s %s-%d /%s/%s/%d %d\n' % (i % 86400, rng.choice(levels),
+                rng.choice(WORDS), rng.randint(0, 31), rng.choice(WORDS),
+                rng.choice(WORDS), rng.randint(0, 9999), rng.randint(1, 999)))
@@ -0,0 +1,96 @@
+import time
+
+BACKSPACE = '\b'
+TAB = '\t'
+
+# Keystrokes typed against each kind of corpus; '\b' is a backspace and
+# '\t' starts another search term, as in the UI
+SCRIPTS = {
+    'dir': [
+        'search',
+        'q\tutil\bl\ttest',
+        'cache_pool\b\b\b\b\b\b\b\b\b\bcore',
+        'e\ta\tr',
+        'zzq\b\b\bmain.py',
+    ],
+    'ctags': [
+        'render_view',
+        'get\b\b\bparse\tindex',
+        'x\b',
+        'query_rank_1',
+    ],
+    'stdin': [
+        'error',
+        'warn\tapi/',
+        'worker-3\b1\tsearch',
+        '/http/json/12',
+    ],
+}
+
+def keystrokes(script):
+    "Splits a script into ('type', char), ('tab', TAB) and ('backspace', None)"
+    for c in script:
+        if c == BACKSPACE:
+            yield 'backspace', None
+        elif c == TAB:
+            yield 'tab', TAB
+        else:
+            yield 'type', c
+
+def replay(orderer, script, rows=40):
+    """
+    Types a script into an orderer the way the UI does: each keystroke
+    pushes or pops one query, after which a screen of top items and the
+    count are fetched.  Returns the seconds each push, pop and top took.
+    """
+    timings = {'push': [], 'pop': [], 'top': []}
+    query = ''
+    depth = 0
+    for action, c in keystrokes(script):
+        start = time.time()
+        if action == 'backspace':
+            if depth == 0:
+                continue
+            orderer.pop_query()
+            query = query[:-1]
+            depth -= 1
+            op = 'pop'
+        else:
+            query += c
+            orderer.push_query(query)
+            depth += 1
+            op = 'push'
+
+        timings[op].append(time.time() - start)
+
+        start = time.time()
+        orderer.top_items(rows)
+        orderer.item_count()
+        timings['top'].append(time.time() - start)
+
+    # Back to the unfiltered level for the next script; not part of it
+    for _ in range(depth):
+        orderer.pop_query()
+
+    return timings
+
+def percentile(values, p):
+    "Nearest rank percentile of sorted values"
+    if not values:
+        return None
+
+    k = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'n': 0}
+
+    return {
+        'n': len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+        'mean': sum(values) / len(values)
+    }
@@ -0,0 +1,162 @@
+"""
+Runs a single benchmark case, described by a JSON spec, and prints its
+result as JSON.  Each case gets a process of its own so its peak memory
+is its own.
+"""
+import os, sys, json, time, subprocess
+
+from quickfind.Orderer import STOrderer, MTOrderer, AdaptiveOrderer, auto_select
+from quickfind.Pool import shutdown_pools
+from quickfind.source.DirectorySource import DirectorySource, ranker, dirFormatter
+from quickfind.source.GitIndexSource import GitIndexSource
+from quickfind.source.CtagsSource import CtagsSource, CtagsRanker, CtagsFormatter
+from quickfind.source.Util import StringRanker, line_part, simpleFormatter
+from quickfind.Session import load, replay as replay_session
+
+from .Corpus import Corpus
+from .Replay import SCRIPTS, replay, summarize
+
+class Unsupported(Exception):
+    pass
+
+def walk(corpus, cache=None):
+    return DirectorySource([corpus.tree], ignore_files=False, cache=cache).stream()
+
+def dir_source(corpus):
+    return ranker(False), walk(corpus), 'dir'
+
+def dir_path_source(corpus):
+    return ranker(True), walk(corpus), 'dir'
+
+def dir_cached_source(corpus):
+    # The first walk fills the cache; the one timed reuses it
+    cache = os.path.join(corpus.root, 'walk.cache')
+    for _ in walk(corpus, cache=cache):
+        pass
+
+    return ranker(False), walk(corpus, cache=cache), 'dir'
+
+def git_source(corpus):
+    if not os.path.isdir(os.path.join(corpus.tree, '.git')):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git', 'init', '-q', '.'], cwd=corpus.tree, stdout=devnull)
+            subprocess.check_call(['git', 'add', '-A'], cwd=corpus.tree, stdout=devnull)
+
+    return ranker(False), GitIndexSource([corpus.tree], ignore_files=False).stream(), 'dir'
+
+def ctags_source(corpus):
+    return CtagsRanker, CtagsSource(corpus.tags).stream(), 'ctags'
+
+def read_lines(path):
+    "As qf reads stdin"
+    with open(path) as f:
+        for i, line in enumerate(f):
+            yield (i, line.strip())
+
+def stdin_source(corpus):
+    return StringRanker.new(get_part=line_part), read_lines(corpus.lines), 'stdin'
+
+# name -> function of the corpus returning (ranker, item stream, script set)
+SOURCES = {
+    'dir': dir_source,
+    'dir-path': dir_path_source,
+    'dir-cached': dir_cached_source,
+    'git': git_source,
+    'ctags': ctags_source,
+    'stdin': stdin_source
+}
+
+# script set -> function of the screen width returning the UI's formatter
+FORMATTERS = {
+    'dir': lambda cols: dirFormatter,
+    'ctags': CtagsFormatter,
+    'stdin': lambda cols: lambda item, query, dims: simpleFormatter(item[1], query, dims)
+}
+
+def vector_orderer(rank, items, procs):
+    from quickfind.VectorOrderer import VectorOrderer
+    if not VectorOrderer.supports(rank):
+        raise Unsupported("The vector engine needs numpy and a StringRanker")
+
+    return VectorOrderer(rank, items)
+
+# name -> function of (ranker, items, worker count) returning an orderer
+ORDERERS = {
+    'st': lambda rank, items, procs: STOrderer(rank, items),
+    'index': lambda rank, items, procs: STOrderer(rank, items, index=True),
+    'mt': lambda rank, items, procs: MTOrderer(rank, items, procs),
+    'adaptive': lambda rank, items, procs: AdaptiveOrderer(rank, items, procs),
+    'vector': vector_orderer,
+    'auto': lambda rank, items, procs: auto_select(rank, items, procs=procs)
+}
+
+def peak_rss():
+    "Peak resident memory of this process and of its largest child, in KiB"
+    try:
+        import resource
+    except ImportError:
+        return None, None
+
+    # Linux counts in KiB, macOS in bytes
+    scale = 1024 if sys.platform == 'darwin' else 1
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale
+    return own, children
+
+def run_case(spec):
+    """
+    Loads a source into an orderer and replays the scripts for its corpus
+    `repeat` times, then any recorded sessions of its kind through the UI
+    loop.  Times are in seconds.
+    """
+    # A unicode root would have Python 2 walk the tree as unicode too
+    corpus = Corpus(str(spec['data']), **spec['sizes'])
+    result = {'source': spec['source'], 'orderer': spec['orderer'], 'procs': spec['procs']}
+
+    rank, stream, kind = SOURCES[spec['source']](corpus)
+    start = time.time()
+    items = list(stream)
+    result['items'] = len(items)
+    result['source_s'] = time.time() - start
+
+    try:
+        start = time.time()
+        orderer = ORDERERS[spec['orderer']](rank, items, spec['procs'])
+        result['ingest_s'] = time.time() - start
+    except Unsupported as e:
+        result['skipped'] = str(e)
+        return result
+
+    timings = {'push': [], 'pop': [], 'top': []}
+    try:
+        for _ in range(spec['repeat']):
+            for script in spec.get('scripts') or SCRIPTS[kind]:
+                for op, seconds in replay(orderer, script, spec['rows']).items():
+                    timings[op].extend(seconds)
+    finally:
+        orderer.cleanup()
+
+    # Each session gets a fresh orderer, which it cleans up; keys are sent
+    # as soon as the one before has been drawn
+    sessions = [load(path) for path in spec.get('sessions') or []]
+    sessions = [s for s in sessions if s.get('source') in (None, kind)]
+    if sessions:
+        render = []
+        for session in sessions:
+            orderer = ORDERERS[spec['orderer']](rank, items, spec['procs'])
+            printf = FORMATTERS[kind](session.get('cols', 80))
+            printer, _ = replay_session(session, orderer, printf=printf, speed=None)
+            render.extend(seconds for _, seconds in printer.latencies)
+
+        result['render'] = summarize(render)
+
+    # Workers only report their memory once they've exited
+    shutdown_pools()
+    for op, seconds in timings.items():
+        result[op] = summarize(seconds)
+
+    result['peak_rss_kb'], result['workers_peak_rss_kb'] = peak_rss()
+    return result
+
+if __name__ == '__main__':
+    print(json.dumps(run_case(json.loads(sys.argv[1]))))
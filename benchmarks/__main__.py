@@ -0,0 +1,159 @@
+"""
+Benchmarks quickfind's sources and orderers on synthetic corpora:
+
+    python -m benchmarks --scale 0.2 --out results.json
+
+Each case loads one source into one orderer, then replays scripted
+keystrokes against it.  The JSON written holds, per case, the time to read
+the source and build the orderer, push/pop/top latency percentiles and the
+peak memory of the process and its workers.  Sessions recorded with
+`qf --record` can be replayed through the whole UI loop as well, timing
+each key until its results are drawn.
+"""
+from __future__ import print_function
+import os, sys, json, time, platform, tempfile, subprocess
+import argparse
+import multiprocessing
+
+from .Corpus import Corpus
+from .Run import SOURCES, ORDERERS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks for quickfind')
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'quickfind-bench'),
+            help='Directory the corpus is generated in, and reused from')
+    parser.add_argument('--files', type=int, default=50000,
+            help='Files in the directory tree')
+    parser.add_argument('--tags', type=int, default=200000,
+            help='Tags in the tags file')
+    parser.add_argument('--lines', type=int, default=1000000,
+            help='Lines in the stdin stream')
+    parser.add_argument('--scale', type=float, default=1.0,
+            help='Multiplies every corpus size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sources', default='dir,dir-path,ctags,stdin',
+            help='Comma separated, out of: %s' % ', '.join(sorted(SOURCES)))
+    parser.add_argument('--orderers', default='st,index,mt,adaptive,vector',
+            help='Comma separated, out of: %s' % ', '.join(sorted(ORDERERS)))
+    parser.add_argument('--procs', type=int, default=min(multiprocessing.cpu_count(), 6),
+            help='Workers for the multiprocess orderers')
+    parser.add_argument('--rows', type=int, default=40,
+            help='Top items fetched after each keystroke')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Times each script is replayed')
+    parser.add_argument('--script', action='append', dest='scripts', default=None,
+            help="Replays this instead of the built in scripts; '\\b' is a "
+                 "backspace and '\\t' a tab.  May be repeated.")
+    parser.add_argument('--session', action='append', dest='sessions', default=None,
+            help="Also replays a session recorded with qf --record against the cases "
+                 "for its source.  May be repeated.")
+    parser.add_argument('--out', default=None,
+            help='Writes the results here instead of stdout')
+
+    return parser.parse_args()
+
+def unescape(script):
+    return script.replace('\\b', '\b').replace('\\t', '\t')
+
+def revision():
+    "The commit benchmarked, when run from a git checkout"
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=devnull)
+        return out.decode('ascii').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def run(spec):
+    "Runs a case in its own interpreter, against this checkout's quickfind"
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    out = subprocess.check_output([sys.executable, '-m', 'benchmarks.Run', json.dumps(spec)],
+            cwd=ROOT, env=env)
+    return json.loads(out.decode('utf-8'))
+
+def describe(result):
+    name = '%s/%s' % (result['source'], result['orderer'])
+    if 'skipped' in result:
+        return '%-20s skipped: %s' % (name, result['skipped'])
+
+    ms = lambda s: '%7.2fms' % (s * 1000) if s is not None else '      -'
+    line = '%-20s %9d items  source %6.2fs  ingest %6.2fs  push %s %s  pop %s  top %s  rss %dMB' % (
+            name, result['items'], result['source_s'], result['ingest_s'],
+            ms(result['push'].get('p50')), ms(result['push'].get('p99')),
+            ms(result['pop'].get('p50')), ms(result['top'].get('p50')),
+            (result['peak_rss_kb'] or 0) // 1024)
+
+    if 'render' in result:
+        line += '  render %s %s' % (ms(result['render'].get('p50')),
+                ms(result['render'].get('p99')))
+
+    return line
+
+def main():
+    args = build_arg_parser()
+    sizes = {
+        'files': int(args.files * args.scale),
+        'tags': int(args.tags * args.scale),
+        'lines': int(args.lines * args.scale),
+        'seed': args.seed
+    }
+
+    sources = [s for s in args.sources.split(',') if s]
+    orderers = [o for o in args.orderers.split(',') if o]
+    for name in sources:
+        if name not in SOURCES:
+            raise SystemExit("Unknown source %r" % name)
+    for name in orderers:
+        if name not in ORDERERS:
+            raise SystemExit("Unknown orderer %r" % name)
+
+    start = time.time()
+    Corpus(args.data, **sizes).ensure()
+    print('corpus ready in %.1fs' % (time.time() - start), file=sys.stderr)
+
+    results = []
+    for source in sources:
+        for orderer in orderers:
+            spec = {
+                'data': args.data,
+                'sizes': sizes,
+                'source': source,
+                'orderer': orderer,
+                'procs': args.procs,
+                'rows': args.rows,
+                'repeat': args.repeat,
+                'scripts': [unescape(s) for s in args.scripts] if args.scripts else None,
+                'sessions': [os.path.abspath(s) for s in args.sessions or []]
+            }
+            result = run(spec)
+            results.append(result)
+            print(describe(result), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'procs': args.procs,
+            'sizes': sizes,
+            'rows': args.rows,
+            'repeat': args.repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        },
+        'results': results
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,10 @@
+" Set to 1 to search through a running `qf --serve`, when there is one
+let g:qf_remote = get(g:, 'qf_remote', 0)
+
+function! s:flags()
+  return g:qf_remote ? " --remote" : ""
+endfunction
+
 function! QuickFind(...)
   if a:0 > 0
     let dir = a:1
@@ -6,14 +13,14 @@ function! QuickFind(...)
   endif
 
   let tmpfile=tempname()
-  let command = "qf " . dir . " -o > " . tmpfile
+  let command = "qf " . dir . s:flags() . " -o > " . tmpfile
   return s:evaluate(command, tmpfile)
 endfunction
 command! -nargs=* QF call QuickFind(<q-args>)
 
 function! QuickFindC()
   let tmpfile=tempname()
-  let command = "qf -c -o > " . tmpfile
+  let command = "qf -c" . s:flags() . " -o > " . tmpfile
   return s:evaluate(command, tmpfile)
 endfunction
 command! -nargs=0 TS call QuickFindC()
@@ -0,0 +1,56 @@
+from array import array
+
+class NGramIndex(object):
+    """
+    Maps the bigrams and trigrams of each item's search key to the ids of
+    the items containing them.  For a query, intersecting the postings of
+    its grams gives a (usually small) superset of the matching items, which
+    the exact ranker then only has to check.
+    """
+
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, ids, keys):
+        postings = self.postings
+        for i, key in zip(ids, keys):
+            grams = set(key[j:j+2] for j in range(len(key) - 1))
+            grams.update(key[j:j+3] for j in range(len(key) - 2))
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('i')
+
+                posting.append(i)
+
+    def grams(self, term):
+        if len(term) == 2:
+            return [term]
+
+        return set(term[j:j+3] for j in range(len(term) - 2))
+
+    def candidates(self, terms):
+        """
+        Sorted ids of the items that can contain every term, or None if the
+        terms are too short to narrow anything down.
+        """
+        lists = []
+        for term in terms:
+            for gram in self.grams(term):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    return array('i')
+
+                lists.append(posting)
+
+        if not lists:
+            return None
+
+        lists.sort(key=len)
+        ids = set(lists[0])
+        for posting in lists[1:]:
+            ids.intersection_update(posting)
+            if not ids:
+                break
+
+        return array('i', sorted(ids))
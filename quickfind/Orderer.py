@@ -1,9 +1,18 @@
-from operator import add
-from multiprocessing import Process, Pipe, cpu_count
-import heapq
-import random
+import heapq, time
+from array import array
+from itertools import islice
+
+from .Pool import ItemStore, get_pool
+from .Index import NGramIndex
+
+class Interrupted(Exception):
+    "Raised out of a push_query whose query is no longer wanted"
 
 class Orderer(object):
+    # Optional callable, polled during long pushes; when it returns True the
+    # push is abandoned with Interrupted and the query stack left unchanged
+    interrupt = None
+
     def push_query(self, query):
         raise NotImplementedError()
 
@@ -16,139 +25,885 @@ class Orderer(object):
     def item_count(self):
         raise NotImplementedError()
 
+    def extend(self, items):
+        raise NotImplementedError()
+
+    def discard(self, items):
+        raise NotImplementedError()
+
     def cleanup(self):
         raise NotImplementedError()
 
+# How a level can build on the one before it, when both rankers score term
+# by term: the same terms, only the last one edited, or one added after them
+SAME, LAST, NEXT = 'same', 'last', 'next'
+
+def carried(prev, rank):
+    """
+    How a push of `rank` can reuse the partial sums of a level `prev`
+    ranked, or None if every term has to be ranked again.  An edited single
+    term query is ranked again, having no partial sums to reuse.
+    """
+    if prev is None or not getattr(rank, 'incremental', False):
+        return None
+
+    old, new = prev.terms, rank.terms
+    if not old or not new:
+        return None
+    elif new == old:
+        return SAME
+    elif len(new) > 1 and new[:-1] == old[:-1]:
+        return LAST
+    elif new[:-1] == old:
+        return NEXT
+
+    return None
+
+def from_window(window, N, count):
+    "Serves the top N from a cached, sorted window if it covers them"
+    if window is not None and (len(window) >= N or len(window) == count):
+        return window[:N]
+
+    return None
+
 class STOrderer(Orderer):
+    """
+    Keeps a stack of query levels.  The first level is the item list itself;
+    each later level is stored compactly as the ids (positions in the item
+    list) of the items that survived it, with a parallel array of scores.
 
-    def __init__(self, ranker, items):
-        self.ranker = ranker
-        its = [(0, item) for item in items]
-        self.heaps = [its]
+    With `index`, an n-gram index over the rankers' search keys is built as 
+    items come in, and a push only ranks the items it says can match.
 
-    @property
-    def lhq(self):
-        return self.heaps[-1]
+    Keyed rankers have each item's search key and static weight worked out
+    once, as the item comes in, and kept in arrays parallel to the items.
 
-    def _ranker(self, ranker, curHeap):
-        for _, item in curHeap:
-            score = ranker.rank(item)
-            if score is not None:
-                yield score, item
+    For incremental rankers, levels of several terms also keep each
+    survivor's score over all but the last term.  Typing into the last term
+    then only looks for that term in the previous level's survivors.
+    """
+
+    # Items ranked between polls of `interrupt`
+    CHECK_EVERY = 5000
+
+    def __init__(self, ranker, items, index=False):
+        self.ranker = ranker
+        self.items = list(items)
+        self.keyed = getattr(ranker(''), 'keyed', False)
+        self.keys, self.weights = [], array('d')
+        if self.keyed:
+            self._prepare(0)
+
+        self.index = None
+        if index:
+            self.index = NGramIndex()
+            self._index(0)
+
+        # (ids, scores, partial sums or None) per level; None for the
+        # unfiltered first level
+        self.levels = [None]
+        self.rankers = [None]
+
+        # Sorted top window of each level, kept until the level changes
+        self.windows = [None]
+
+        # Ids of discarded items.  They stay in `items` so ids don't shift,
+        # but no level keeps them.
+        self.dead = set()
+
+    def _ids(self, level):
+        return range(len(self.items)) if level is None else level[0]
+
+    def _prepare(self, start):
+        rank = self.ranker('')
+        items = self.items
+        self.keys.extend(rank.key(items[i]) for i in range(start, len(items)))
+        self.weights.extend(rank.weight(items[i]) for i in range(start, len(items)))
+
+    def _index(self, start):
+        ids = range(start, len(self.items))
+        if self.keyed:
+            keys = self.keys[start:]
+        else:
+            key, items = self.ranker('').key, self.items
+            keys = (key(items[i]) for i in ids)
+
+        self.index.add(ids, keys)
+
+    def _candidates(self, rank, level):
+        "The ids of `level`, narrowed down with the index if it helps"
+        ids = self._ids(level)
+        if self.index is None or rank.terms is None:
+            return ids
+
+        candidates = self.index.candidates(rank.terms)
+        if candidates is None or len(candidates) >= len(ids):
+            return ids
+
+        if level is not None:
+            # The index covers every item, including those the level has
+            # already dropped or handed over to another worker
+            keep = set(ids)
+            candidates = array('i', (i for i in candidates if i in keep))
+
+        return candidates
+
+    def _ranker(self, ranker, ids, interrupt=None):
+        items, keys, weights = self.items, self.keys, self.weights
+        keyed = self.keyed
+        if keyed and getattr(ranker, 'incremental', False) and len(ranker.terms) > 1:
+            return self._split_ranker(ranker, ids, interrupt)
+
+        rank = ranker.rank_key if keyed else ranker.rank
+        survivors, scores = array('i'), array('d')
+        step = self.CHECK_EVERY if interrupt is not None else max(len(ids), 1)
+        for start in range(0, len(ids), step):
+            if interrupt is not None and interrupt():
+                raise Interrupted()
+
+            for i in ids[start:start + step]:
+                score = rank(keys[i], weights[i]) if keyed else rank(items[i])
+                if score is not None:
+                    survivors.append(i)
+                    scores.append(score)
+
+        return survivors, scores, None
+
+    def _split_ranker(self, ranker, ids, interrupt=None):
+        "Ranks every term, keeping the partial sums"
+        keys, weights = self.keys, self.weights
+        rank = ranker.rank_terms
+        survivors, scores, partials = array('i'), array('d'), array('d')
+        step = self.CHECK_EVERY if interrupt is not None else max(len(ids), 1)
+        for start in range(0, len(ids), step):
+            if interrupt is not None and interrupt():
+                raise Interrupted()
+
+            for i in ids[start:start + step]:
+                split = rank(keys[i])
+                if split is not None:
+                    partial, score = split
+                    survivors.append(i)
+                    scores.append(partial + score + weights[i])
+                    partials.append(partial)
+
+        return survivors, scores, partials
+
+    def _carried(self, prev, rank, level):
+        "How `rank` can build on `level`, which `prev` ranked"
+        if not self.keyed or level is None:
+            return None
+
+        how = carried(prev, rank)
+        if how in (LAST, NEXT) and level[2] is None and len(prev.terms) > 1:
+            # Handed over without its partial sums
+            return None
+
+        return how
+
+    def _carry(self, how, prev, rank, level, interrupt=None):
+        "Ranks the survivors of `level` by the last term of `rank` alone"
+        ids, scores, partials = level
+        if how == SAME:
+            return (array('i', ids), array('d', scores),
+                    None if partials is None else array('d', partials))
+
+        keys, weights = self.keys, self.weights
+        rank_term, term = rank.rank_term, rank.terms[-1]
+
+        # A new term moves the one before it into the partial sums
+        added = prev.terms[-1] if how == NEXT else None
+        survivors, out, sums = array('i'), array('d'), array('d')
+        step = self.CHECK_EVERY if interrupt is not None else max(len(ids), 1)
+        for start in range(0, len(ids), step):
+            if interrupt is not None and interrupt():
+                raise Interrupted()
+
+            for k in range(start, min(start + step, len(ids))):
+                i = ids[k]
+                score = rank_term(term, keys[i])
+                if score is None:
+                    continue
+
+                partial = 0.0 if partials is None else partials[k]
+                if added is not None:
+                    partial += rank_term(added, keys[i])
+
+                survivors.append(i)
+                out.append(partial + score + weights[i])
+                sums.append(partial)
+
+        return survivors, out, sums
 
     def cleanup(self):
         pass
 
     def push_query(self, query):
         rank = self.ranker(query)
-        self.heaps.append( list(self._ranker(rank, self.lhq)) )
+        level = self.levels[-1]
+        how = self._carried(self.rankers[-1], rank, level)
+        if how is not None:
+            level = self._carry(how, self.rankers[-1], rank, level, self.interrupt)
+        else:
+            ids = self._candidates(rank, level)
+            level = self._ranker(rank, ids, self.interrupt)
+
+        if self.dead:
+            level = self._alive(level)
+
+        self.rankers.append(rank)
+        self.levels.append(level)
+        self.windows.append(None)
 
     def pop_query(self):
-        self.heaps.pop()
+        self.levels.pop()
+        self.rankers.pop()
+        self.windows.pop()
+
+    def push_scored(self, rank, scores, partials=None):
+        "Pushes a level of every item, whose scores are already known"
+        self.rankers.append(rank)
+        self.levels.append((array('i', range(len(self.items))), array('d', scores),
+            None if partials is None else array('d', partials)))
+        self.windows.append(None)
+
+    def split(self, n):
+        """
+        Removes up to n survivors from the current level as (score, item,
+        partial sum or None) triples
+        """
+        ids, scores, partials = self.levels[-1]
+        start = max(len(ids) - n, 0)
+        items = self.items
+        triples = [(scores[k], items[ids[k]], None if partials is None else partials[k])
+                for k in range(start, len(ids))]
+        del ids[start:]
+        del scores[start:]
+        if partials is not None:
+            del partials[start:]
+
+        self.windows[-1] = None
+        return triples
+
+    def extend(self, items):
+        "Adds a batch of items, ranking it against each query on the stack"
+        start = len(self.items)
+        self.items.extend(items)
+        if self.keyed:
+            self._prepare(start)
+        if self.index is not None:
+            self._index(start)
+
+        # The batch goes down the stack like a query would, each level
+        # building on the batch's survivors of the one before
+        prev, batch = None, None
+        ids = range(start, len(self.items))
+        for rank, level in zip(self.rankers[1:], self.levels[1:]):
+            how = self._carried(prev, rank, batch)
+            if how is not None:
+                batch = self._carry(how, prev, rank, batch)
+            else:
+                batch = self._ranker(rank, ids)
+
+            prev, ids = rank, batch[0]
+            level[0].extend(batch[0])
+            level[1].extend(batch[1])
+            if level[2] is not None:
+                level[2].extend(batch[2])
+
+        self.windows = [None] * len(self.levels)
+
+    def _alive(self, level):
+        ids, scores, partials = level
+        dead = self.dead
+        keep = [k for k, i in enumerate(ids) if i not in dead]
+        return (array('i', (ids[k] for k in keep)), array('d', (scores[k] for k in keep)),
+                None if partials is None else array('d', (partials[k] for k in keep)))
+
+    def discard(self, items):
+        "Removes items from every level, finding them with a scan of all items"
+        gone = set(items)
+        dead = self.dead
+        ids = [i for i, item in enumerate(self.items) if item in gone and i not in dead]
+        if not ids:
+            return
+
+        dead.update(ids)
+        self.levels = [None] + [self._alive(level) for level in self.levels[1:]]
+        self.windows = [None] * len(self.levels)
 
     def top_items(self, N):
         return [item for _, item in self._top_items(N)]
 
     def _top_items(self, N):
-        return heapq.nsmallest(N, self.lhq)
+        top = from_window(self.windows[-1], N, self.item_count())
+        if top is None:
+            level = self.levels[-1]
+            if level is None:
+                dead = self.dead
+                alive = (i for i in range(len(self.items)) if i not in dead)
+                top = [(0, i) for i in islice(alive, N)]
+            else:
+                top = heapq.nsmallest(N, zip(level[1], level[0]))
+
+            self.windows[-1] = top
+
+        items = self.items
+        return [(score, items[i]) for score, i in top]
 
     def item_count(self):
-        return len(self.lhq)
+        if self.levels[-1] is None:
+            return self.total_count()
+
+        return len(self.levels[-1][0])
 
     def total_count(self):
-        return len(self.heaps[0])
+        return len(self.items) - len(self.dead)
+
+class IndexedRanker(object):
+    "Ranks integer item ids by looking them up in a worker's item table"
+
+    def __init__(self, ranker, table):
+        self.ranker = ranker
+        self.table = table
+
+    def __call__(self, query):
+        return IndexedRank(self.ranker(query), self.table)
+
+class IndexedRank(object):
+    __slots__ = ('ranker', 'rank_f', 'rank_key', 'rank_term', 'rank_terms', 'table')
+
+    def __init__(self, rank, table):
+        self.ranker = rank
+        self.rank_f = rank.rank
+        self.rank_key = getattr(rank, 'rank_key', None)
+        self.rank_term = getattr(rank, 'rank_term', None)
+        self.rank_terms = getattr(rank, 'rank_terms', None)
+        self.table = table
 
-class LightSlice(object):
-    "Not copying the list saves time on big item sets"
+    @property
+    def terms(self):
+        return self.ranker.terms
+
+    @property
+    def keyed(self):
+        return getattr(self.ranker, 'keyed', False)
+
+    @property
+    def incremental(self):
+        return getattr(self.ranker, 'incremental', False)
+
+    def rank(self, idx):
+        return self.rank_f(self.table[idx])
+
+    def key(self, idx):
+        return self.ranker.key(self.table[idx])
 
-    def __init__(self, items, start, end):
+    def weight(self, idx):
+        return self.ranker.weight(self.table[idx])
+
+class ItemTable(object):
+    "A worker's items: a contiguous block from the store plus stragglers"
+
+    def __init__(self, items, start):
         self.items = items
         self.start = start
-        self.end = end
+        self.end = start + len(items)
+        self.extra = {}
 
-    def __iter__(self):
-        end = len(self.items) if self.end is None else self.end
-        items = self.items
-        for i in xrange(self.start, end):
-            yield items[i]
-
-def m_target(ranker, items, start, end, pipe):
-    try:
-        batch = LightSlice(items, start, end)
-        orderer = STOrderer(ranker, batch)
-        while True:
-            command, args = pipe.recv()
-            if command == 'exit':
-                return
-
-            res = getattr(orderer, command)(*args)
-            if res is not None:
-                pipe.send(res)
-
-    except KeyboardInterrupt:
-        pass
-    finally:
-        pipe.close()
+    def __getitem__(self, idx):
+        if self.start <= idx < self.end:
+            return self.items[idx - self.start]
 
-class MTOrderer(Orderer):
+        return self.extra[idx]
+
+    def update(self, idxs, items):
+        self.extra.update(zip(idxs, items))
+
+class WorkerSession(object):
+    """
+    One MTOrderer's share of the items and query stack, inside a worker.
+
+    Besides its own block, a worker can hold guests: survivors handed over
+    from busier workers at some level, which follow the query stack until 
+    that level is popped.
+    """
+
+    def __init__(self, ranker, path, start, end, index=False):
+        self.table = ItemTable(ItemStore.load(path, start, end), start)
+        self.orderer = STOrderer(IndexedRanker(ranker, self.table), 
+                range(start, end), index)
+        self.guests = []
+
+        # command -> [calls, seconds, slowest], for tracing
+        self.timings = {}
+
+    def timed(self, command, seconds):
+        t = self.timings.get(command)
+        if t is None:
+            t = self.timings[command] = [0, 0.0, 0.0]
+
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+    def stats(self):
+        "Time spent on each command so far"
+        return dict(self.timings)
+
+    def depth(self):
+        return len(self.orderer.levels) - 1
+
+    def push_query(self, query):
+        self.orderer.push_query(query)
+        for _, guest in self.guests:
+            guest.push_query(query)
+
+    def pop_query(self):
+        depth = self.depth()
+        self.orderer.pop_query()
+        self.guests = [(d, g) for d, g in self.guests if d < depth]
+        for _, guest in self.guests:
+            guest.pop_query()
+
+    def extend(self, idxs, items):
+        self.table.update(idxs, items)
+        self.orderer.extend(idxs)
 
-    def __init__(self, ranker, items, count):
-        self._total_count = len(items)
+    def discard(self, idxs):
+        self.orderer.discard(idxs)
+        for _, guest in self.guests:
+            guest.discard(idxs)
 
-        procs = []
-        pipes = []
-        batch_size = len(items) / count
-        for i in xrange(count):
-            start = batch_size * i
-            end = None if i == (count - 1) else start + batch_size
+    def item_count(self):
+        return self.orderer.item_count() + sum(g.item_count() for _, g in self.guests)
 
-            parent, child = Pipe()
-            procs.append(Process(target=m_target, args=(ranker, items, start, end, child)))
-            procs[-1].start()
-            pipes.append(parent)
+    def _top_items(self, N):
+        top = self.orderer._top_items(N)
+        for _, guest in self.guests:
+            top = heapq.nsmallest(N, top + guest._top_items(N))
+
+        return top
+
+    def give(self, n):
+        """
+        Hands over up to n survivors of the current level as (id, item,
+        score, partial sum or None)
+        """
+        triples = []
+        for orderer in [self.orderer] + [g for _, g in self.guests]:
+            if len(triples) >= n:
+                break
+
+            triples.extend(orderer.split(n - len(triples)))
+
+        return [(idx, self.table[idx], score, partial) for score, idx, partial in triples]
+
+    def take(self, moved):
+        "Takes in survivors given up by another worker at the current level"
+        idxs = [idx for idx, _, _, _ in moved]
+        self.table.update(idxs, [item for _, item, _, _ in moved])
+        partials = None
+        if moved and moved[0][3] is not None:
+            partials = [partial for _, _, _, partial in moved]
+
+        guest = STOrderer(self.orderer.ranker, idxs)
+        guest.push_scored(self.orderer.rankers[-1], [score for _, _, score, _ in moved],
+                partials)
+        self.guests.append((self.depth(), guest))
+
+def m_target(pipe):
+    sessions = {}
+    while True:
+        sid, command, args = pipe.recv()
+        if command == 'exit':
+            return
+
+        start = time.time()
+        if command == 'open':
+            session = sessions[sid] = WorkerSession(*args)
+            res = session.item_count()
+        elif command == 'close':
+            sessions.pop(sid, None)
+            session = res = None
+        else:
+            session = sessions[sid]
+            res = getattr(session, command)(*args)
+
+        if session is not None:
+            session.timed(command, time.time() - start)
+
+        if res is not None:
+            pipe.send(res)
 
-        self.procs = procs
-        self.pipes = pipes
+class MTOrderer(Orderer):
+    """
+    Splits the items across a pool of worker processes.  The items are 
+    packed once into a shared store which each worker reads its block from; 
+    afterwards only queries, item ids and scores cross the pipes.  The pool
+    outlives the orderer and is reused by later ones in the same process.
+
+    Queries often leave most survivors in one worker's block, so after each
+    push the survivors of a lopsided level are spread evenly again.
+    """
+
+    # Rebalance when a worker holds this many times its even share...
+    REBALANCE_RATIO = 1.5
+
+    # ...and the level has at least this many survivors
+    REBALANCE_MIN = 20000
+
+    def __init__(self, ranker, items, count, pool=None, index=False):
+        self.items = list(items)
+        self.pool = pool if pool is not None else get_pool(count, m_target)
+        self.sid = self.pool.new_session()
+
+        # Merged top window and per worker survivor counts of each level, 
+        # so redraws and cursor movement don't go back to the workers
+        self.windows = [None]
+        self.counts = [None]
+        self.dead = set()
+
+        store = ItemStore(self.items)
+        try:
+            with self.pool.lock:
+                for i, pipe in enumerate(self.pool.pipes):
+                    start, end = store.bounds(i, len(self.pool))
+                    pipe.send([self.sid, 'open', [ranker, store.path, start, end, index]])
+
+                # Wait for every worker to have its block before dropping the store
+                self._evict_pipe()
+        finally:
+            store.close()
 
     def _evict_pipe(self):
-        return [pipe.recv() for pipe in self.pipes]
+        return [pipe.recv() for pipe in self.pool.pipes]
 
     def _eval_func(self, name, args):
-        for pipe in self.pipes:
-            pipe.send([name, args])
+        for pipe in self.pool.pipes:
+            pipe.send([self.sid, name, args])
+
+    def _fan_out(self, name, args):
+        with self.pool.lock:
+            self._eval_func(name, args)
+            return self._evict_pipe()
 
     def push_query(self, query):
-        self._eval_func('push_query', [query])
+        with self.pool.lock:
+            self._eval_func('push_query', [query])
+
+        self.windows.append(None)
+        self.counts.append(None)
+        self._rebalance()
+
+    def _rebalance(self):
+        counts = self._counts()
+        total = sum(counts)
+        target = total // len(counts)
+        if total < self.REBALANCE_MIN or max(counts) <= target * self.REBALANCE_RATIO:
+            return
+
+        donors = [(i, c - target) for i, c in enumerate(counts) if c > target]
+        takers = [(i, target - c) for i, c in enumerate(counts) if c < target]
+        pipes = self.pool.pipes
+        with self.pool.lock:
+            for i, excess in donors:
+                pipes[i].send([self.sid, 'give', [excess]])
+
+            moved = []
+            for i, _ in donors:
+                moved.extend(pipes[i].recv())
+
+            counts = list(counts)
+            for i, _ in donors:
+                counts[i] = target
+
+            start = 0
+            for n, (i, deficit) in enumerate(takers):
+                # Whatever doesn't divide evenly goes to the last one
+                end = len(moved) if n == len(takers) - 1 else start + deficit
+                pipes[i].send([self.sid, 'take', [moved[start:end]]])
+                counts[i] += end - start
+                start = end
+
+        self.counts[-1] = counts
 
     def pop_query(self):
-        self._eval_func('pop_query', [])
+        with self.pool.lock:
+            self._eval_func('pop_query', [])
+
+        self.windows.pop()
+        self.counts.pop()
+
+    def extend(self, items):
+        # Spread each batch across the workers to keep them even
+        start = len(self.items)
+        self.items.extend(items)
+        count = len(self.pool)
+        with self.pool.lock:
+            for i, pipe in enumerate(self.pool.pipes):
+                idxs = list(range(start + i, len(self.items), count))
+                pipe.send([self.sid, 'extend', [idxs, items[i::count]]])
+
+        self.windows = [None] * len(self.windows)
+        self.counts = [None] * len(self.counts)
+
+    def discard(self, items):
+        gone = set(items)
+        dead = self.dead
+        idxs = [i for i, item in enumerate(self.items) if item in gone and i not in dead]
+        if not idxs:
+            return
+
+        dead.update(idxs)
+        with self.pool.lock:
+            self._eval_func('discard', [idxs])
+
+        self.windows = [None] * len(self.windows)
+        self.counts = [None] * len(self.counts)
+
+    def _top(self, N):
+        "The top N (score, id) pairs across the workers"
+        top = from_window(self.windows[-1], N, self.item_count())
+        if top is None:
+            top_items = []
+            for ti in self._fan_out('_top_items', [N]):
+                top_items.extend(ti)
+
+            top = self.windows[-1] = heapq.nsmallest(N, top_items)
+
+        return top
 
     def top_items(self, N):
-        self._eval_func('_top_items', [N])
-        top_items = []
-        for ti in self._evict_pipe():
-            top_items.extend(ti)
-        
-        heapq.heapify(top_items)
-        return [item for _, item in heapq.nsmallest(N, top_items)]
+        items = self.items
+        return [items[idx] for _, idx in self._top(N)]
         
+    def _counts(self):
+        if self.counts[-1] is None:
+            self.counts[-1] = self._fan_out('item_count', [])
+
+        return self.counts[-1]
+
+    def item_count(self):
+        return sum(self._counts())
+
+    def total_count(self):
+        return len(self.items) - len(self.dead)
+
+    def worker_stats(self):
+        "Per worker {command: [calls, seconds, slowest]} for this orderer"
+        return self._fan_out('stats', [])
+
+    def cleanup(self):
+        with self.pool.lock:
+            self._eval_func('close', [])
+
+class AdaptiveOrderer(Orderer):
+    """
+    Uses an MTOrderer while the query is broad and, once a level's survivors
+    drop below `threshold`, gathers them into a local STOrderer so narrower
+    queries skip the fan-out to the workers.  Backspacing past that level
+    hands the query stack back to the workers.
+
+    Without a threshold, one is calibrated from the cost of a round trip to
+    the workers against the cost of ranking an item locally.
+    """
+
+    def __init__(self, ranker, items, count, threshold=None, pool=None, index=False):
+        self.ranker = ranker
+        self.mt = MTOrderer(ranker, items, count, pool=pool, index=index)
+        self.queries = []
+        self.local = None
+        self.threshold = threshold
+        if threshold is None:
+            self.threshold = self.calibrate()
+
+    def calibrate(self, samples=2000, trips=5):
+        items = self.mt.items[:samples]
+        if not items:
+            return 0
+
+        # Timed the way a local orderer ranks
+        local = STOrderer(self.ranker, items)
+        rank = self.ranker('e')
+        start = time.time()
+        local._ranker(rank, range(len(items)))
+        per_item = max((time.time() - start) / len(items), 1e-9)
+
+        start = time.time()
+        for _ in range(trips):
+            self.mt._fan_out('item_count', [])
+        trip = (time.time() - start) / trips
+
+        # Local wins while n * per_item < trip + n * per_item / workers
+        workers = len(self.mt.pool)
+        if workers < 2:
+            return AUTO_THRESHOLD
+
+        return int(trip / (per_item * (1 - 1.0 / workers)))
+
+    def _gather(self):
+        "Pulls the current level's survivors out of the workers"
+        mt = self.mt
+        ids = sorted(i for _, i in mt._top(mt.item_count()))
+
+        # Kept in id order so ties still break the way the workers' do
+        self.local = STOrderer(self.ranker, [mt.items[i] for i in ids])
+        self.local.interrupt = self.interrupt
+
+    def push_query(self, query):
+        if self.local is not None:
+            self.local.push_query(query)
+            self.queries.append(query)
+            return
+
+        self.mt.push_query(query)
+        self.queries.append(query)
+        if self.mt.item_count() <= self.threshold:
+            self._gather()
+
+    def pop_query(self):
+        self.queries.pop()
+        if self.local is not None and len(self.local.levels) > 1:
+            self.local.pop_query()
+            return
+
+        # Back above the level we gathered at
+        self.local = None
+        self.mt.pop_query()
+
+    @property
+    def active(self):
+        "The orderer answering for the current level"
+        if self.local is not None and len(self.local.levels) > 1:
+            return self.local
+
+        return self.mt
+
+    def extend(self, items):
+        self.mt.extend(items)
+        if self.local is not None:
+            # Survivors of the gathered level are all the local one needs;
+            # queries only narrow, so its query alone decides them
+            depth = len(self.queries) - (len(self.local.levels) - 1)
+            rank = self.ranker(self.queries[depth - 1])
+            self.local.extend([item for item in items if rank.rank(item) is not None])
+
+    def discard(self, items):
+        self.mt.discard(items)
+        if self.local is not None:
+            self.local.discard(items)
+
+    def top_items(self, N):
+        return self.active.top_items(N)
+
     def item_count(self):
-        self._eval_func('item_count', [])
-        return reduce(add, self._evict_pipe())
+        return self.active.item_count()
 
     def total_count(self):
-        return self._total_count
+        return self.mt.total_count()
+
+    def worker_stats(self):
+        return self.mt.worker_stats()
 
     def cleanup(self):
-        self._eval_func('exit', [])
-        for pipe in self.pipes:
-            pipe.close()
+        self.mt.cleanup()
 
-        for proc in self.procs:
-            proc.join()
+# Item count past which auto_select forks workers
+AUTO_THRESHOLD = 10000
+
+def auto_select(ranker, items, N=AUTO_THRESHOLD, procs=4, index=False, vector=False):
+    """
+    Picks an engine for the items: workers for large sets, unless `vector`
+    asks for the NumPy engine and the ranker supports it.
+    """
+    if vector:
+        from .VectorOrderer import VectorOrderer
+        if VectorOrderer.supports(ranker):
+            return VectorOrderer(ranker, items)
 
-def auto_select(ranker, items, N=10000, procs=4):
     if len(items) > N:
-        return MTOrderer(ranker, items, procs)
+        return AdaptiveOrderer(ranker, items, procs, index=index)
+
+    return STOrderer(ranker, items, index)
+
+def start_workers(procs=4):
+    """
+    Starts the pool auto_select's workers come from, if it isn't running.
+    A fork made while other threads run can copy locks they hold, so code
+    that builds orderers on a thread starts the pool first.
+    """
+    get_pool(procs, m_target)
+
+class GrowingOrderer(Orderer):
+    """
+    For items that are still arriving: ranks them in-process with an
+    STOrderer while there are few, and once there are more than `threshold`
+    moves them and the query stack to the orderer `build(ranker, items)`
+    makes for them.  Items keep their order, so ties break the same way.
+    """
+
+    def __init__(self, ranker, build, threshold=AUTO_THRESHOLD, index=False):
+        self.ranker = ranker
+        self.build = build
+        self.threshold = threshold
+        self.orderer = STOrderer(ranker, [], index)
+        self.queries = []
+        self.grown = False
+        self._interrupt = None
+
+    @property
+    def interrupt(self):
+        return self._interrupt
+
+    @interrupt.setter
+    def interrupt(self, interrupt):
+        self._interrupt = interrupt
+        self.orderer.interrupt = interrupt
+
+    def _grow(self):
+        small = self.orderer
+        dead = small.dead
+        orderer = self.build(self.ranker,
+                [item for i, item in enumerate(small.items) if i not in dead])
+
+        # Not interruptible until it has caught up with the stack
+        for query in self.queries:
+            orderer.push_query(query)
+
+        orderer.interrupt = self._interrupt
+        self.orderer = orderer
+        self.grown = True
+        small.cleanup()
+
+    def push_query(self, query):
+        self.orderer.push_query(query)
+        self.queries.append(query)
+
+    def pop_query(self):
+        self.queries.pop()
+        self.orderer.pop_query()
+
+    def top_items(self, N):
+        return self.orderer.top_items(N)
+
+    def item_count(self):
+        return self.orderer.item_count()
 
-    return STOrderer(ranker, items)
+    def total_count(self):
+        return self.orderer.total_count()
+
+    def extend(self, items):
+        self.orderer.extend(items)
+        if not self.grown and self.orderer.total_count() > self.threshold:
+            self._grow()
+
+    def discard(self, items):
+        self.orderer.discard(items)
+
+    def worker_stats(self):
+        stats = getattr(self.orderer, 'worker_stats', None)
+        return stats() if stats is not None else None
+
+    def cleanup(self):
+        self.orderer.cleanup()
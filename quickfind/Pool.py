@@ -0,0 +1,144 @@
+import os, struct, signal, tempfile, threading, atexit, mmap
+from multiprocessing import Process, Pipe
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def shm_dir():
+    "tmpfs backed, where available, so the store never touches the disk"
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class ItemStore(object):
+    """
+    Items pickled once, in fixed size chunks, into a shared memory file.
+    Workers load just the chunks covering their range instead of inheriting
+    copies of the entire item list.
+
+    Layout: item count, chunk count, chunk offsets, pickled chunks.
+    """
+    CHUNK = 1024
+    HEADER = struct.Struct('<QQ')
+
+    def __init__(self, items):
+        chunks = [pickle.dumps(items[i:i + self.CHUNK], pickle.HIGHEST_PROTOCOL)
+                for i in range(0, len(items), self.CHUNK)]
+
+        offsets = [0]
+        for chunk in chunks:
+            offsets.append(offsets[-1] + len(chunk))
+
+        fd, self.path = tempfile.mkstemp(prefix='quickfind-', dir=shm_dir())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.HEADER.pack(len(items), len(chunks)))
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+            for chunk in chunks:
+                f.write(chunk)
+
+        self.count = len(items)
+        self.chunks = len(chunks)
+
+    def bounds(self, i, count):
+        "Item range of the i'th of `count` workers"
+        return self.count * i // count, self.count * (i + 1) // count
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def load(cls, path, start, end):
+        "Unpickles items [start, end) from a store"
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            count, chunks = cls.HEADER.unpack_from(buf, 0)
+            base = cls.HEADER.size + 8 * (chunks + 1)
+            offsets = struct.unpack_from('<%dQ' % (chunks + 1), buf, cls.HEADER.size)
+
+            first = start // cls.CHUNK
+            items = []
+            for c in range(first, (end + cls.CHUNK - 1) // cls.CHUNK):
+                items.extend(pickle.loads(buf[base + offsets[c]:base + offsets[c + 1]]))
+
+            skip = start - first * cls.CHUNK
+            return items[skip:skip + end - start]
+        finally:
+            buf.close()
+
+def worker_main(target, pipe):
+    # The parent owns the workers' lifetime; don't die with the terminal's ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        target(pipe)
+    except (EOFError, IOError):
+        pass
+    finally:
+        pipe.close()
+
+class WorkerPool(object):
+    """
+    Long lived worker processes, shared by every session in a process.
+    Commands sent down `pipes` are answered in order, so `lock` must be held
+    for a full round trip across the workers.
+    """
+
+    def __init__(self, count, target):
+        self.lock = threading.RLock()
+        self.procs = []
+        self.pipes = []
+        self.sessions = 0
+        for _ in range(count):
+            parent, child = Pipe()
+            proc = Process(target=worker_main, args=(target, child))
+            proc.daemon = True
+            proc.start()
+            child.close()
+            self.procs.append(proc)
+            self.pipes.append(parent)
+
+    def __len__(self):
+        return len(self.pipes)
+
+    def alive(self):
+        return all(p.is_alive() for p in self.procs)
+
+    def new_session(self):
+        with self.lock:
+            self.sessions += 1
+            return self.sessions
+
+    def shutdown(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send([None, 'exit', []])
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+        for proc in self.procs:
+            proc.join(1)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(count, target):
+    "Returns the process-wide pool of `count` workers, starting it if needed"
+    with _pools_lock:
+        pool = _pools.get((count, target))
+        if pool is None or not pool.alive():
+            pool = _pools[(count, target)] = WorkerPool(count, target)
+
+        return pool
+
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+
+        _pools.clear()
@@ -1,16 +1,24 @@
 from __future__ import print_function
-import sys, tty, termios, os
+import sys, tty, termios, os, time, select, fcntl
 import heapq
+import threading
+from collections import deque
 from contextlib import contextmanager
 import curses
 import multiprocessing
 
+from .Orderer import Interrupted
+from . import Trace
+
 if sys.version_info.major >= 3:
     textize = str
 else:
     textize = lambda x: unicode(x, errors="ignore")
 
 class Output(object):
+    # Descriptor that ends a getChar timeout early once it's readable
+    wakeup = None
+
     def init(self):
         raise NotImplementedError()
 
@@ -23,9 +31,20 @@ class Output(object):
     def getChr(self):
         raise NotImplementedError()
 
+    def setTimeout(self, ms):
+        raise NotImplementedError()
+
+    def setWakeup(self, fd):
+        "Has getChar give up waiting, returning -1, once fd is readable"
+        self.wakeup = fd
+
     def printQuery(self, q):
         raise NotImplementedError()
 
+    def prepare(self, items):
+        "Called with all the items of a frame before they are printed"
+        pass
+
     def printItem(self, item, highlighted, selected, query):
         raise NotImplementedError()
 
@@ -35,6 +54,13 @@ class Output(object):
     def flush(self):
         raise NotImplementedError()
 
+    def rendered(self, query, ranked):
+        """
+        Called after each frame is flushed with the query typed and the 
+        query its results are for, which lags while ranking
+        """
+        pass
+
     def cleanup(self):
         raise NotImplementedError()
 
@@ -54,6 +80,12 @@ class ScreenPrinter(Output):
     def dimensions(self):
         return self.cols, self.rows
 
+    def setTimeout(self, ms):
+        self.getChar.timeout = ms
+
+    def setWakeup(self, fd):
+        self.getChar.wakeup = fd
+
     def clear(self):
         print("")
 
@@ -72,6 +104,15 @@ class ScreenPrinter(Output):
         pass
 
 class CursesPrinter(Output):
+    """
+    Draws frames as diffs against the previous one: each row is rendered to
+    (text, attributes) segments and only rows that differ are rewritten, so 
+    moving the cursor or narrowing the query doesn't repaint the screen.
+    """
+
+    # Least time between terminal refreshes, in seconds.  A skipped refresh
+    # is done by the next flush, or by curses before it reads a key.
+    MIN_REFRESH = 1 / 60.0
     
     def __init__(self, printf):
         self.printf = printf
@@ -79,6 +120,13 @@ class CursesPrinter(Output):
         self.colors = {}
         self.TAB = CString("~", fcolor="red")
 
+        # row -> (column, segments) of the frame on screen and the next one
+        self.lines = {}
+        self.frame = {}
+        self.size = None
+        self.refreshed = 0
+        self.timeout = -1
+
     def init(self):
         self.window = curses.initscr()
         self.window.nodelay(0)
@@ -87,7 +135,26 @@ class CursesPrinter(Output):
         curses.noecho()
 
     def getChar(self):
-        return self.window.getch()
+        if self.wakeup is None or self.timeout <= 0:
+            return self.window.getch()
+
+        # Curses may hold keys it has already read, which select can't see
+        self.window.timeout(0)
+        try:
+            ch = self.window.getch()
+            if ch == -1:
+                ready, _, _ = select.select([sys.stdin.fileno(), self.wakeup], [], [],
+                        self.timeout / 1000.0)
+                if sys.stdin.fileno() in ready:
+                    ch = self.window.getch()
+        finally:
+            self.window.timeout(self.timeout)
+
+        return ch
+
+    def setTimeout(self, ms):
+        self.timeout = ms
+        self.window.timeout(ms)
 
     def cleanup(self):
         curses.echo()
@@ -105,40 +172,53 @@ class CursesPrinter(Output):
         newQ = self.convert(newQ[:-1])
 
         self.querylen = len(q)
-        for nq in newQ:
-            self._printText(nq, len(q))
+        self.frame[0] = (0, self._segments(newQ, len(q)))
     
-    def _printText(self, t, maxX, flags=curses.A_NORMAL):
-        text = t.text[:(maxX - self.window.getyx()[1])]
-        if not text: return
+    def _attr(self, t):
         if t.fcolor == t.bcolor == -1:
-            self.window.addstr(text, t.weight | flags)
-        else:
-            cp = (t.fcolor, t.bcolor)
-            if cp not in self.colors:
-                num = 1 if not self.colors else max(self.colors.values()) + 1 
-                self.colors[cp] = num
-                curses.init_pair(num, t.fcolor, t.bcolor)
-
-            self.window.addstr(text, curses.color_pair(self.colors[cp]) | t.weight | flags)
+            return t.weight
+
+        # Pairs stay allocated across frames
+        cp = (t.fcolor, t.bcolor)
+        if cp not in self.colors:
+            num = 1 if not self.colors else max(self.colors.values()) + 1 
+            self.colors[cp] = num
+            curses.init_pair(num, t.fcolor, t.bcolor)
+
+        return curses.color_pair(self.colors[cp]) | t.weight
+
+    def _segments(self, texts, maxX, flags=curses.A_NORMAL):
+        "(text, attributes) pairs for a row, cut off at maxX"
+        segments = []
+        x = 0
+        for t in texts:
+            text = t.text[:(maxX - x)]
+            if not text: continue
+            segments.append((text, self._attr(t) | flags))
+            x += len(text)
+
+        return tuple(segments)
+
+    def prepare(self, items):
+        # Lets formatters that read from disk do a screen's worth at once
+        prefetch = getattr(self.printf, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(items)
 
     def printItem(self, idx, item, highlighted, selected, query):
         flags = curses.A_BOLD if highlighted else curses.A_NORMAL
         if selected:
             flags |= curses.A_UNDERLINE
 
-        self.window.move(1 + idx, 0)
-        colors = {}
-        num = 1
         x, y = self.dimensions()
-        for t in self.convert(self.printf(item, query, (x,y))):
-            self._printText(t, x, flags)
+        texts = self.convert(self.printf(item, query, (x,y)))
+        self.frame[1 + idx] = (0, self._segments(texts, x, flags))
 
     def printCount(self, total, current):
         x, y = self.dimensions()
 
         counts = "[%s / %s]" % (current, total)
-        self.window.addstr(y-1, x - len(counts)-1, counts)
+        self.frame[y - 1] = (x - len(counts) - 1, ((counts, curses.A_NORMAL),))
 
     def convert(self, text):
         if not isinstance(text, list):
@@ -151,12 +231,36 @@ class CursesPrinter(Output):
         return r
 
     def clear(self):
-        self.window.clear()
-        self.colors.clear()
+        self.frame = {}
 
     def flush(self):
+        size = self.dimensions()
+        if size != self.size:
+            # Resized; nothing on screen can be trusted
+            self.window.erase()
+            self.lines = {}
+            self.size = size
+
+        for row in set(self.lines) | set(self.frame):
+            line = self.frame.get(row)
+            if line == self.lines.get(row):
+                continue
+
+            self.window.move(row, 0)
+            self.window.clrtoeol()
+            if line is not None:
+                col, segments = line
+                self.window.move(row, col)
+                for text, attr in segments:
+                    self.window.addstr(text, attr)
+
+        self.lines, self.frame = self.frame, {}
         self.window.move(0, self.querylen)
-        self.window.refresh()
+
+        now = time.time()
+        if now - self.refreshed >= self.MIN_REFRESH:
+            self.window.refresh()
+            self.refreshed = now
 
 class CString(object):
     __slots__ = ('text', 'fcolor', 'bcolor', "weight")
@@ -194,40 +298,451 @@ class GetchUnix(object):
     def __init__(self):
         import tty, sys
         self.fd = sys.stdin.fileno()
+        self.timeout = -1
+        self.wakeup = None
 
     def __call__(self):
         old_settings = termios.tcgetattr(self.fd)
         try:
             tty.setraw(self.fd)
+            if self.timeout >= 0:
+                fds = [self.fd] if self.wakeup is None else [self.fd, self.wakeup]
+                ready, _, _ = select.select(fds, [], [], self.timeout / 1000.0)
+                if self.fd not in ready:
+                    return -1
+
             ch = sys.stdin.read(1)
         finally:
             termios.tcsetattr(self.fd, termios.TCSADRAIN, old_settings)
         return ch
 
 class Ranker(object):
+    # Lowered substrings every match must contain, when the ranker knows them
+    terms = None
+
+    # True when rank(item) == rank_key(key(item), weight(item)); orderers
+    # then work out each item's key and weight once, as it comes in
+    keyed = False
+
     def __init__(self, query):
         self.query = query
 
     def rank(self, item):
         raise NotImplementedError()
 
+    def key(self, item):
+        "The lowered string that `terms` are looked for in"
+        raise NotImplementedError()
+
+    def weight(self, item):
+        "The part of an item's score that doesn't depend on the query"
+        return 0.0
+
+    def rank_key(self, key, weight):
+        "rank() of an item from its key() and weight()"
+        raise NotImplementedError()
+
+    # True for keyed rankers whose rank_key adds up a score per term, in
+    # order: (((0.0 + s1) + s2) ... + sn) + weight.  Orderers then keep each
+    # survivor's sum over all but the last term between levels, so a push
+    # that only edits or adds the last term scores just that one
+    incremental = False
+
+    def rank_term(self, term, key):
+        "One term's score for a key, or None if the key doesn't match it"
+        raise NotImplementedError()
+
+    def rank_terms(self, key):
+        """
+        rank_key without the weight, split into the sum over all but the
+        last term and the last term's score; None if any term doesn't match
+        """
+        raise NotImplementedError()
+
+class Feeder(object):
+    """
+    Pulls items off a possibly slow iterator in the background.  Items are
+    handed over as soon as they're read, however few, in batches of up to
+    `batch_size`.
+    """
+
+    def __init__(self, items, batch_size=5000):
+        self.batch_size = batch_size
+        self.pending = deque()
+        self.finished = False
+        self.done = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(items,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, items):
+        pending = self.pending
+        count = 0
+        try:
+            with Trace.phase('source.read') as args:
+                for count, item in enumerate(items, 1):
+                    pending.append(item)
+
+                args['items'] = count
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+
+        if Trace.tracer is not None:
+            Trace.tracer.snapshot('loaded')
+
+    def drain(self):
+        "Returns all the batches that have arrived since the last call"
+        if self.done:
+            return []
+
+        # Read first: anything appended before the end was seen is taken too
+        finished = self.finished
+        pending = self.pending
+        items = [pending.popleft() for _ in range(len(pending))]
+        if finished:
+            self.done = True
+            if self.error is not None:
+                raise self.error
+
+        size = self.batch_size
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+class Evaluator(object):
+    """
+    Runs the orderer on a background thread so keys keep being read while it
+    ranks.  The UI only says which query it wants: the evaluator takes the 
+    query stack straight there, skipping whatever was typed in between, and 
+    abandons a push once the query moves somewhere it can't build on.  Items
+    from a Feeder are added on the same thread, as are changes reported by
+    `updates`, a callable returning (added, removed) items.
+    """
+
+    def __init__(self, orderer, feeder=None, updates=None, interval=0.05,
+            watch_interval=0.5):
+        self.orderer = orderer
+        self.feeder = feeder
+        self.updates = updates
+        self.interval = interval
+        self.watch_interval = watch_interval
+
+        # Held while the orderer is in use
+        self.lock = threading.Lock()
+
+        # Guards the fields below; notified when the results change
+        self.cond = threading.Condition()
+        self.target = ""
+        self.queries = []
+        self.pushing = None
+        self.working = False
+        self.version = 0
+        self.error = None
+        self.closed = False
+
+        # Written to whenever a pass finishes, so a UI waiting on keys can
+        # wait on this too and draw new results straight away
+        self.wakeup, self.waker = os.pipe()
+        for fd in (self.wakeup, self.waker):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        orderer.interrupt = self._superseded
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _superseded(self):
+        # Extensions of the query being pushed can still be built on it
+        return self.closed or not self.target.startswith(self.pushing)
+
+    def _current(self):
+        return self.queries[-1] if self.queries else ""
+
+    def _feeding(self):
+        return self.feeder is not None and not self.feeder.done
+
+    def set_query(self, query):
+        with self.cond:
+            self.target = query
+            self.cond.notify_all()
+
+    def busy(self):
+        "True until the orderer has caught up with the query and the source"
+        with self.cond:
+            return self.working or self.target != self._current() or self._feeding()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and self.target == self._current():
+                        if self._feeding():
+                            self.cond.wait(self.interval)
+                            break
+                        elif self.updates is not None:
+                            self.cond.wait(self.watch_interval)
+                            break
+
+                        self.cond.wait()
+
+                    if self.closed:
+                        return
+
+                    self.working = True
+                    target = self.target
+
+                with self.lock:
+                    changed = self._ingest()
+                    changed = self._update() or changed
+                    changed = self._sync(target) or changed
+
+                with self.cond:
+                    self.working = False
+                    if changed:
+                        self.version += 1
+                    self.cond.notify_all()
+
+                self._wake()
+
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.working = False
+                self.cond.notify_all()
+
+            self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self.waker, b'.')
+        except OSError:
+            # Full, so a wakeup is pending already; or closed
+            pass
+
+    def woken(self):
+        "Clears the wakeups written so far"
+        try:
+            while os.read(self.wakeup, 512):
+                pass
+        except OSError:
+            pass
+
+    def _ingest(self):
+        if not self._feeding():
+            return False
+
+        batches = self.feeder.drain()
+        for batch in batches:
+            self.orderer.extend(batch)
+
+        return len(batches) > 0
+
+    def _update(self):
+        # Changes are only tracked once the source is fully read
+        if self.updates is None or self._feeding():
+            return False
+
+        with Trace.phase('source.updates') as args:
+            added, removed = self.updates()
+            args['added'], args['removed'] = len(added), len(removed)
+
+        if removed:
+            self.orderer.discard(removed)
+        if added:
+            self.orderer.extend(added)
+
+        return bool(added or removed)
+
+    def _sync(self, target):
+        "Pops levels the target doesn't extend, then pushes it in one go"
+        orderer, queries = self.orderer, self.queries
+        changed = False
+        while queries and not target.startswith(queries[-1]):
+            orderer.pop_query()
+            queries.pop()
+            changed = True
+
+        if target != self._current():
+            self.pushing = target
+            try:
+                orderer.push_query(target)
+            except Interrupted:
+                return changed
+
+            queries.append(target)
+            changed = True
+
+        return changed
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def wait(self):
+        "Blocks until the orderer has caught up with the query"
+        with self.cond:
+            while self.error is None and (self.working or self.target != self._current()):
+                self.cond.wait(self.interval)
+
+        self.check()
+
+    def snapshot(self, N):
+        """
+        (top N items, total, count, the query they're for), or None while
+        the orderer is busy
+        """
+        if not self.lock.acquire(False):
+            return None
+
+        try:
+            orderer = self.orderer
+            return (orderer.top_items(N), orderer.total_count(), orderer.item_count(),
+                    self._current())
+        finally:
+            self.lock.release()
+
+    def top_items(self, N):
+        self.wait()
+        with self.lock:
+            return self.orderer.top_items(N)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        with self.lock:
+            self.orderer.cleanup()
+
+        # Done with its last pass; it mustn't write to the pipe once closed
+        self.thread.join()
+        os.close(self.wakeup)
+        os.close(self.waker)
+
+def rank_queries(orderer, queries, N):
+    """
+    Answers queries without a UI, yielding (query, top N items) for each.
+    A query that extends the one before it is ranked on top of its level.
+    """
+    stack = []
+    for query in queries:
+        while stack and not query.startswith(stack[-1]):
+            orderer.pop_query()
+            stack.pop()
+
+        if query != (stack[-1] if stack else ""):
+            orderer.push_query(query)
+            stack.append(query)
+
+        yield query, orderer.top_items(N)
+
 class Searcher(object):
+    # How often to check for new results, in milliseconds, while the query 
+    # is being ranked or items are still arriving
+    REFRESH = 50
+
+    # ...and while watching for changes to the items
+    WATCH_REFRESH = 250
+
     def __init__(self, output, multiselect=False):
         self.output = output
         self.multiselect = multiselect
 
-    def _loop(self, orderer, getchar, cur):
+        # Last (items, total, count, query) drawn, with the version it came from
+        self.frame = ([], 0, 0, "")
+        self.shown = None
+
+        # A key read ahead while draining a burst
+        self.pending = None
+
+    def _editing(self, nextchar):
+        "Keys that only change the query text"
+        return nextchar not in (-1, 27, 10, 13, 3, 4, 28, 26)
+
+    def _edit(self, cur, nextchar):
+        # Delete/backspace
+        if nextchar in (8, 127):
+            return cur[:-1]
+
+        return cur + chr(nextchar)
+
+    def _burst(self, getchar, cur):
+        """
+        Applies the query edits already waiting in the input, so a paste or 
+        fast typing becomes one query instead of a redraw per key.
+        """
+        self.output.setTimeout(0)
+        try:
+            while True:
+                nextchar = getchar()
+                if not self._editing(nextchar):
+                    if nextchar != -1:
+                        self.pending = nextchar
+                    return cur
+
+                cur = self._edit(cur, nextchar)
+        finally:
+            self.output.setTimeout(-1)
+
+    def _getchar(self, getchar, evaluator, redraw):
+        "Waits for the next key, redrawing as results come in"
+        if self.pending is not None:
+            nextchar, self.pending = self.pending, None
+            return nextchar
+
+        if evaluator.busy():
+            nextchar = self._poll(getchar, evaluator, redraw, self.REFRESH, evaluator.busy)
+            if nextchar != -1:
+                return nextchar
+
+        evaluator.check()
+        if evaluator.version != self.shown:
+            redraw()
+
+        if evaluator.updates is not None:
+            # Items can change at any time
+            return self._poll(getchar, evaluator, redraw, self.WATCH_REFRESH, lambda: True)
+
+        return getchar()
+
+    def _poll(self, getchar, evaluator, redraw, timeout, waiting):
+        "Reads a key, checking for new results every `timeout` ms while waiting()"
+        self.output.setTimeout(timeout)
+        try:
+            while waiting():
+                nextchar = getchar()
+                evaluator.check()
+                if nextchar != -1:
+                    return nextchar
+
+                # Cleared after the wait, so a pass finishing from here on
+                # still cuts the next one short
+                evaluator.woken()
+
+                # Results that came in while it was still working
+                if evaluator.version != self.shown and not evaluator.working:
+                    redraw()
+        finally:
+            self.output.setTimeout(-1)
+
+        return -1
+
+    def _loop(self, evaluator, getchar, cur):
 
-        # If we've seeded the query, build the heap stack
-        for i in range(1, len(cur) + 1):
-            orderer.push_query(cur[:i])
+        # A seeded query is ranked in a single push; the levels for its 
+        # prefixes are only built if backspacing reaches them
+        evaluator.set_query(cur)
 
         highlighted = 0
         selections = []
         while True:
-            self._echo(cur, orderer, highlighted, selections)
+            self._echo(cur, evaluator, highlighted, selections)
+
+            redraw = lambda: self._echo(cur, evaluator, highlighted, selections)
+            with Trace.phase('ui.wait'):
+                nextchar = self._getchar(getchar, evaluator, redraw)
 
-            nextchar = getchar()
             cols, rows = self.output.dimensions()
 
             # Ansi escape for alt and arrow keys
@@ -246,7 +761,7 @@ class Searcher(object):
 
                 # Down
                 if nextchar == 66:
-                    itemsShown = min(rows, orderer.item_count()) - 1
+                    itemsShown = min(rows, self.frame[2]) - 1
                     highlighted = min(itemsShown, highlighted + 1)
                 # Up 
                 elif nextchar == 65:
@@ -254,7 +769,9 @@ class Searcher(object):
 
                 # Selected
             elif nextchar in (10, 13):
-                h = orderer.top_items(highlighted + 1)
+                with Trace.phase('ui.select'):
+                    h = evaluator.top_items(highlighted + 1)
+
                 try:
                     k = h[highlighted]
                     if k in selections:
@@ -279,41 +796,62 @@ class Searcher(object):
                 if nextchar in (3,4, 28, 26):
                     raise KeyboardInterrupt()
 
-                # Delete/backspace
-                if nextchar in (8, 127):
-                    if cur != "":
-                        cur = cur[:-1]
-                        orderer.pop_query()
-                else:
-                    cur += chr(nextchar)
-                    orderer.push_query(cur)
+                with Trace.phase('ui.burst'):
+                    cur = self._burst(getchar, self._edit(cur, nextchar))
 
-    def _echo(self, query, orderer, highlighted, selections):
-        self.output.clear()
-        self.output.printQuery(query)
+                evaluator.set_query(cur)
 
+    def _echo(self, query, evaluator, highlighted, selections):
         cols, rows = self.output.dimensions()
-        
-        s = set(selections)
-        for i, item in enumerate(orderer.top_items(rows - 2)):
-            self.output.printItem(i, item, i==highlighted, item in s, query)
 
-        self.output.printCount(orderer.total_count(), orderer.item_count())
-        self.output.flush()
+        # While a query is being ranked, the typed query is shown over the 
+        # last results
+        version = evaluator.version
+        frame = evaluator.snapshot(rows - 2)
+        if frame is not None:
+            self.frame, self.shown = frame, version
+
+        items, total, count, ranked = self.frame
+        with Trace.phase('ui.render', items=len(items), stale=frame is None):
+            self.output.clear()
+            self.output.printQuery(query)
+
+            s = set(selections)
+            self.output.prepare(items)
+            for i, item in enumerate(items):
+                self.output.printItem(i, item, i==highlighted, item in s, query)
+
+            self.output.printCount(total, count)
+            self.output.flush()
+
+        self.output.rendered(query, ranked)
 
     @contextmanager
     def redirStdout(self):
         stdout = os.dup(sys.stdout.fileno())
         os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
-        yield
-        os.dup2(stdout, sys.stdout.fileno())
-
-    def run(self, orderer, q=""):
+        try:
+            yield
+        finally:
+            os.dup2(stdout, sys.stdout.fileno())
+            os.close(stdout)
+
+    def run(self, orderer, q="", feed=None, updates=None, getchar=None):
+        """
+        Runs the search UI.  `feed` is an optional iterator of items still
+        to come; they are added to the orderer as they arrive.  `updates`,
+        if given, is polled for (added, removed) items once the feed ends.
+        Keys are read from `getchar`, when given, instead of the output.
+        """
+        feeder = Feeder(feed) if feed is not None else None
+        evaluator = Evaluator(orderer, feeder, updates)
         with self.redirStdout():
             self.output.init()
+            self.output.setWakeup(evaluator.wakeup)
             try:
-                return self._loop(orderer, self.output.getChar, q)
+                return self._loop(evaluator, getchar or self.output.getChar, q)
             finally:
-                orderer.cleanup()
+                self.output.setWakeup(None)
+                evaluator.close()
                 self.output.cleanup()
 
@@ -0,0 +1,375 @@
+import os, sys, stat, time, json, socket, signal, tempfile, threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from .Orderer import Orderer, auto_select, start_workers, from_window
+from .source.DirectorySource import File, ranker
+from .source.GitIndexSource import stream_files
+from .source.CtagsSource import CtagsSource, CtagsRanker, Entry
+
+def socket_path():
+    "Per user, in the runtime dir when there is one"
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, 'quickfind-%d.sock' % os.getuid())
+
+def load_dir(base, label, file_type, git_ignore, inc_path, tracked, walk):
+    """
+    Items are listed from the same source the client would list them from,
+    and labelled the same way, so they match the same queries.  Walks are
+    cached and watched to keep them current, through the source's bound
+    updates(); its close() stops the watch.
+    """
+    items, updates = stream_files([label], file_type, git_ignore, untracked=not tracked,
+            walk=walk, base=base, cache=True, watch=True)
+    return ranker(inc_path), items, updates
+
+def load_ctags(path):
+    return CtagsRanker, CtagsSource(path).stream(), None
+
+# kind -> (loader, item type)
+KINDS = {
+    'dir': (load_dir, File),
+    'ctags': (load_ctags, Entry)
+}
+
+class ServedIndex(object):
+    """
+    One root's items and orderer, used by one client at a time.  Sources 
+    that report their changes are kept current in the background; others 
+    are rebuilt after each session, so the next one sees changes without
+    waiting for them.
+    """
+
+    # Seconds between checks for changes
+    WATCH_INTERVAL = 1.0
+
+    def __init__(self, load, options):
+        self.load = load
+        self.options = options
+        self.lock = threading.Lock()
+        self.orderer = None
+        self.rebuilding = False
+        self.watched = False
+        self.watcher = None
+        self.stopped = threading.Event()
+
+        # When a client last opened or let go of it
+        self.used = time.time()
+
+    def build(self):
+        rank, items, updates = self.load()
+        orderer = auto_select(rank, list(items), **self.options)
+        if updates is not None:
+            self.watched = True
+            thread = self.watcher = threading.Thread(target=self._watch, args=(orderer, updates))
+            thread.daemon = True
+            thread.start()
+
+        return orderer
+
+    def _watch(self, orderer, updates):
+        try:
+            while not self.stopped.wait(self.WATCH_INTERVAL):
+                with self.lock:
+                    # Waits for any session to end, so levels are never stacked
+                    if self.stopped.is_set():
+                        break
+
+                    added, removed = updates()
+                    if removed:
+                        orderer.discard(removed)
+                    if added:
+                        orderer.extend(added)
+        finally:
+            updates.__self__.close()
+
+    def refresh(self):
+        if self.rebuilding or self.watched:
+            return
+
+        self.rebuilding = True
+        thread = threading.Thread(target=self._rebuild)
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild(self):
+        try:
+            orderer = self.build()
+            with self.lock:
+                if self.stopped.is_set():
+                    old = orderer
+                else:
+                    old, self.orderer = self.orderer, orderer
+            old.cleanup()
+        finally:
+            self.rebuilding = False
+
+    def stop(self):
+        "Ends the watch, if any, waiting a little for it to close the source"
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join(self.WATCH_INTERVAL)
+
+    def close(self):
+        "Stops keeping the index current and frees it; `lock` must be held"
+        self.stopped.set()
+        if self.orderer is not None:
+            self.orderer.cleanup()
+            self.orderer = None
+
+class Session(socketserver.StreamRequestHandler):
+    """
+    One client connection.  Requests and replies are JSON objects, one per
+    line; a failed request is answered with {"error": message}.
+    """
+
+    def handle(self):
+        self.index = None
+        self.depth = 0
+        try:
+            for line in self.rfile:
+                try:
+                    reply = self.dispatch(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    reply = {'error': '%s: %s' % (type(e).__name__, e)}
+
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        finally:
+            self.close()
+
+    def dispatch(self, req):
+        cmd = req['cmd']
+        if cmd == 'open':
+            self.index = self.server.open(req['kind'], req['args'])
+            return {'total': self.index.orderer.total_count()}
+
+        orderer = self.index.orderer
+        if cmd == 'push':
+            orderer.push_query(req['query'])
+            self.depth += 1
+            return {'count': orderer.item_count()}
+        elif cmd == 'pop':
+            orderer.pop_query()
+            self.depth -= 1
+            return {'count': orderer.item_count()}
+        elif cmd == 'top':
+            return {'items': [list(item) for item in orderer.top_items(req['n'])]}
+
+        raise ValueError("Unknown command %r" % cmd)
+
+    def close(self):
+        index = self.index
+        if index is None:
+            return
+
+        # Leave the orderer as the next client expects to find it
+        for _ in range(self.depth):
+            index.orderer.pop_query()
+
+        index.used = time.time()
+        index.lock.release()
+        index.refresh()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Holds an index per (kind, root, options).  Indexes left unused for
+    IDLE_SECONDS are dropped, as are the least recently used beyond
+    MAX_INDEXES, so a long running server doesn't keep every tree it was
+    ever asked about.
+    """
+    daemon_threads = True
+
+    MAX_INDEXES = 8
+    IDLE_SECONDS = 30 * 60
+
+    # Seconds between checks for idle indexes
+    REAP_INTERVAL = 60.0
+
+    def __init__(self, path, options):
+        self.options = options
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+
+        # Only the owner may connect
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, Session)
+        finally:
+            os.umask(umask)
+
+    def open(self, kind, args):
+        "Returns the index for a client, held until its session ends"
+        key = (kind,) + tuple(args)
+        with self.indexes_lock:
+            index = self.indexes.get(key)
+            if index is None:
+                load = lambda: KINDS[kind][0](*args)
+                index = self.indexes[key] = ServedIndex(load, self.options)
+
+            # Taken before evicting, so this one can't be
+            if not index.lock.acquire(False):
+                raise RuntimeError("Index is in use by another client")
+
+            index.used = time.time()
+            self.evict()
+
+        try:
+            if index.orderer is None:
+                index.orderer = index.build()
+        except:
+            index.lock.release()
+            raise
+
+        return index
+
+    def evict(self):
+        "Drops idle and surplus indexes not in use; `indexes_lock` must be held"
+        now = time.time()
+        surplus = len(self.indexes) - self.MAX_INDEXES
+        for key, index in sorted(self.indexes.items(), key=lambda kv: kv[1].used):
+            if surplus <= 0 and now - index.used < self.IDLE_SECONDS:
+                break
+
+            if not index.lock.acquire(False):
+                continue
+
+            try:
+                index.close()
+            finally:
+                index.lock.release()
+
+            del self.indexes[key]
+            surplus -= 1
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        # Before the interpreter's teardown pulls modules from under them
+        with self.indexes_lock:
+            for index in self.indexes.values():
+                index.stop()
+
+    def reap(self):
+        "Evicts idle indexes, even while no client connects"
+        while True:
+            time.sleep(self.REAP_INTERVAL)
+            with self.indexes_lock:
+                self.evict()
+
+def serve(path=None, **options):
+    """
+    Serves indexes on a Unix socket until interrupted.  `options` are
+    passed to auto_select when building each index's orderer.
+    """
+    path = path or socket_path()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    if os.path.exists(path):
+        try:
+            RemoteOrderer.connect(path).close()
+            raise RuntimeError("A server is already listening on %s" % path)
+        except (IOError, OSError):
+            # Left behind by a server that died
+            os.unlink(path)
+
+    # Orderers are built on the sessions' threads, too late to fork
+    start_workers(options.get('procs', 4))
+
+    server = Server(path, options)
+    reaper = threading.Thread(target=server.reap)
+    reaper.daemon = True
+    reaper.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+class ServerError(Exception):
+    pass
+
+class RemoteOrderer(Orderer):
+    """
+    Runs the query stack against an index held by a `qf --serve` process.
+    The server has every item already and keeps them current, so changes
+    seen on the client side are left to it.
+    """
+
+    def __init__(self, kind, args, path=None):
+        self.sock = self.connect(path or socket_path())
+        self.rfile = self.sock.makefile('rb')
+        self.item_type = KINDS[kind][1]
+        try:
+            self.total = self._call(cmd='open', kind=kind, args=args)['total']
+        except:
+            self.cleanup()
+            raise
+
+        # Top window and count of each level, as the local orderers keep
+        self.windows = [None]
+        self.counts = [self.total]
+
+    @staticmethod
+    def connect(path):
+        # Anyone can create the socket in a shared temp dir; only trust ours
+        st = os.lstat(path)
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            raise ServerError("%s is not a socket of this user's" % path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except:
+            sock.close()
+            raise
+
+        return sock
+
+    def _call(self, **req):
+        self.sock.sendall((json.dumps(req) + '\n').encode('utf-8'))
+        line = self.rfile.readline()
+        if not line:
+            raise ServerError("Server closed the connection")
+
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise ServerError(reply['error'])
+
+        return reply
+
+    def push_query(self, query):
+        count = self._call(cmd='push', query=query)['count']
+        self.windows.append(None)
+        self.counts.append(count)
+
+    def pop_query(self):
+        self._call(cmd='pop')
+        self.windows.pop()
+        self.counts.pop()
+
+    def top_items(self, N):
+        top = from_window(self.windows[-1], N, self.item_count())
+        if top is None:
+            rows = self._call(cmd='top', n=N)['items']
+            top = self.windows[-1] = [self.item_type(*row) for row in rows]
+
+        return top
+
+    def item_count(self):
+        return self.counts[-1]
+
+    def total_count(self):
+        return self.total
+
+    def extend(self, items):
+        "Does nothing: the server lists and watches the items itself"
+
+    def discard(self, items):
+        "Does nothing: the server lists and watches the items itself"
+
+    def cleanup(self):
+        self.rfile.close()
+        self.sock.close()
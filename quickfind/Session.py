@@ -0,0 +1,217 @@
+"""
+Records the keys of a search session, and replays them without a terminal.
+
+A session is the keys the UI read, each with the time it was read at,
+saved as JSON.  Replaying one runs it through the same Searcher loop the UI
+uses, with keys coming from a script and a printer that draws nothing.
+Each keystroke is timed until the first frame showing results for the
+query it produced.
+"""
+import json, time, select
+
+from .Searcher import Output, Searcher, CString
+from .Trace import percentile
+
+# Sent once a replayed session runs out of keys; quits like ^C would
+END = 3
+
+class Recorder(object):
+    "Reads keys from an output, noting each one and when it was read"
+
+    def __init__(self, output, query="", source=None):
+        self.output = output
+        self.query = query
+        self.source = source
+        self.start = None
+        self.dimensions = None
+        self.keys = []
+
+    def __call__(self):
+        if self.start is None:
+            self.start = time.time()
+            self.dimensions = self.output.dimensions()
+
+        key = self.output.getChar()
+        if key != -1:
+            self.keys.append([round(time.time() - self.start, 4), key])
+
+        return key
+
+    def session(self):
+        cols, rows = self.dimensions or (80, 24)
+        return {
+            'version': 1,
+            'source': self.source,
+            'query': self.query,
+            'cols': cols,
+            'rows': rows,
+            'keys': self.keys
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.session(), f)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def plain(text):
+    "The text of what a formatter returns"
+    if not isinstance(text, list):
+        text = [text]
+
+    return ''.join(t.text if isinstance(t, CString) else t for t in text)
+
+class ReplayPrinter(Output):
+    """
+    Plays back a session's keys and draws nothing.  Keys come at the times
+    they were recorded, divided by `speed`; with no speed, each key comes as
+    soon as the one before it has been rendered.  With a `printf`, items
+    are still formatted as the UI would, and with `keep` the text of each
+    frame is kept in `frames`.
+    """
+
+    # Seconds to wait, once out of keys, for the last ones to be rendered
+    LINGER = 10.0
+
+    def __init__(self, session, speed=1.0, printf=None, keep=False):
+        self.keys = session['keys']
+        self.cols = session.get('cols', 80)
+        self.rows = session.get('rows', 24)
+        self.speed = speed
+        self.printf = printf
+        self.keep = keep
+
+        self.timeout = -1
+        self.opened = None
+        self.start = None
+        self.ended = None
+        self.next = 0
+
+        # (key, time it was due) of keys not rendered yet, and (key, seconds)
+        # from each key to its render
+        self.pending = []
+        self.latencies = []
+
+        self.frames = []
+        self.lines = []
+        self.count = None
+
+    def init(self):
+        self.opened = time.time()
+
+    def cleanup(self):
+        pass
+
+    def dimensions(self):
+        return self.cols, self.rows
+
+    def setTimeout(self, ms):
+        self.timeout = ms
+
+    def _wait(self):
+        "Sleeps through a getChar timeout, or until woken"
+        if self.wakeup is None:
+            time.sleep(self.timeout / 1000.0)
+        else:
+            select.select([self.wakeup], [], [], self.timeout / 1000.0)
+
+        return -1
+
+    def getChar(self):
+        now = time.time()
+        if self.start is None:
+            self.start = now
+
+        if self.next == len(self.keys):
+            return self._end(now)
+
+        offset, key = self.keys[self.next]
+        if self.speed:
+            due = self.start + offset / self.speed
+        elif self.pending and self.timeout >= 0:
+            return self._wait()
+        else:
+            due = now
+
+        if due > now:
+            if 0 <= self.timeout < (due - now) * 1000:
+                return self._wait()
+
+            time.sleep(due - now)
+
+        self.next += 1
+        self.pending.append((key, due))
+        return key
+
+    def _end(self, now):
+        if self.ended is None:
+            self.ended = now
+
+        if self.pending and self.timeout >= 0 and now - self.ended < self.LINGER:
+            return self._wait()
+
+        return END
+
+    def clear(self):
+        self.lines = []
+
+    def printQuery(self, query):
+        if self.keep:
+            self.lines.append("$ " + query)
+
+    def printItem(self, idx, item, highlighted, selected, query):
+        if self.printf is None:
+            return
+
+        text = self.printf(item, query, self.dimensions())
+        if self.keep:
+            self.lines.append(plain(text))
+
+    def printCount(self, total, current):
+        self.count = (current, total)
+
+    def flush(self):
+        if self.keep:
+            self.frames.append({'time': time.time() - self.opened, 'lines': self.lines,
+                'count': self.count})
+
+    def rendered(self, query, ranked):
+        # Keys are rendered once the results caught up with what was typed
+        if ranked == query and self.pending:
+            now = time.time()
+            self.latencies.extend((key, now - due) for key, due in self.pending)
+            self.pending = []
+
+    def summary(self):
+        "Seconds from key to render, over the keys that were rendered"
+        seconds = sorted(s for _, s in self.latencies)
+        summary = {'keys': self.next, 'rendered': len(seconds)}
+        if seconds:
+            summary.update({
+                'p50': percentile(seconds, 50),
+                'p99': percentile(seconds, 99),
+                'max': seconds[-1],
+                'mean': sum(seconds) / len(seconds)
+            })
+
+        return summary
+
+def replay(session, orderer, feed=None, updates=None, printf=None, speed=1.0, keep=False,
+        multiselect=False):
+    """
+    Runs a session through the search UI against `orderer`, which is
+    cleaned up after.  Returns the printer, with the latencies, and the
+    selections made, or None if the session quit.
+    """
+    printer = ReplayPrinter(session, speed, printf, keep)
+    searcher = Searcher(printer, multiselect)
+    try:
+        # As typed; JSON hands Python 2 back unicode
+        query = str(session.get('query', ''))
+        selections = searcher.run(orderer, query, feed, updates)
+    except KeyboardInterrupt:
+        selections = None
+
+    return printer, selections
@@ -0,0 +1,328 @@
+"""
+Opt-in tracing, for finding out where the time goes.  Once `start` has
+been called, the UI loop, the sources and every orderer call record how
+long they took; `finish` writes them out as JSON and prints a summary to
+stderr.  The JSON is in the Chrome trace event format, so it also opens
+in chrome://tracing or Perfetto.
+
+When tracing is off, `tracer` is None and `phase` costs a function call.
+"""
+from __future__ import print_function
+import os, sys, json, time, threading, atexit, platform
+
+from .Orderer import Orderer, Interrupted
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+# The running Tracer, if any
+tracer = None
+
+def percentile(values, p):
+    "Nearest rank percentile of sorted values"
+    k = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+class Tracer(object):
+    """
+    Collects timed phases, from any thread.  Phases recorded with `add` are
+    kept individually; ones that happen too often to keep, like per
+    directory work while walking, are only `tally`'d into totals.
+    """
+
+    # Allocation sites listed per memory snapshot
+    TOP_ALLOCATIONS = 10
+
+    def __init__(self, path, memory=False):
+        self.path = path
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+
+        # name -> durations, and name -> [count, seconds, slowest]
+        self.durations = {}
+        self.tallies = {}
+
+        self.levels = []
+        self.workers = None
+        self.snapshots = []
+        self.memory = memory and tracemalloc is not None
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def add(self, name, start, seconds, **args):
+        "Records a phase that began at `start` and took `seconds`"
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+            'ts': int((start - self.start) * 1e6), 'dur': int(seconds * 1e6)
+        }
+        if args:
+            event['args'] = args
+
+        with self.lock:
+            self.events.append(event)
+            self.threads.setdefault(thread.ident, thread.name)
+            self.durations.setdefault(name, []).append(seconds)
+
+    def tally(self, name, seconds):
+        "Adds to the totals of a phase without keeping it"
+        with self.lock:
+            t = self.tallies.get(name)
+            if t is None:
+                t = self.tallies[name] = [0, 0.0, 0.0]
+
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def phase(self, name, **args):
+        return Phase(self, name, args)
+
+    def level(self, query, depth, survivors, seconds):
+        "Records the survivors of a pushed query"
+        with self.lock:
+            self.levels.append({'query': query, 'depth': depth, 'survivors': survivors,
+                'seconds': seconds})
+
+    def snapshot(self, label):
+        "Records the memory allocated so far, and where, when tracing memory"
+        if not self.memory:
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:self.TOP_ALLOCATIONS]
+        with self.lock:
+            self.snapshots.append({
+                'label': label,
+                'time': time.time() - self.start,
+                'current_kb': current // 1024,
+                'peak_kb': peak // 1024,
+                'top': [{'site': str(s.traceback[0]), 'kb': s.size // 1024, 'count': s.count}
+                    for s in stats]
+            })
+
+    def summary(self):
+        "Per phase counts and times, in seconds"
+        phases = {}
+        with self.lock:
+            for name, durations in self.durations.items():
+                durations = sorted(durations)
+                phases[name] = {
+                    'n': len(durations),
+                    'total': sum(durations),
+                    'p50': percentile(durations, 50),
+                    'p99': percentile(durations, 99),
+                    'max': durations[-1]
+                }
+
+            for name, (n, total, slowest) in self.tallies.items():
+                phases[name] = {'n': n, 'total': total, 'max': slowest}
+
+        return phases
+
+    def trace(self):
+        "The whole trace, as written"
+        with self.lock:
+            names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                'args': {'name': name}} for tid, name in self.threads.items()]
+            events = names + list(self.events)
+
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'meta': {
+                'argv': sys.argv,
+                'python': platform.python_version(),
+                'elapsed': time.time() - self.start,
+                'memory': self.memory
+            },
+            'phases': self.summary(),
+            'levels': self.levels,
+            'workers': self.workers,
+            'memory': self.snapshots
+        }
+
+    def write(self):
+        trace = self.trace()
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(trace, f)
+        except (IOError, OSError) as e:
+            print("quickfind: could not write trace to %s: %s" % (self.path, e), file=sys.stderr)
+
+        return trace
+
+    def report(self, trace, out=sys.stderr, rows=12):
+        "A short summary of a trace"
+        ms = lambda s: '%9.2f' % (s * 1000) if s is not None else '        -'
+        print("quickfind trace: %.2fs, written to %s" % (trace['meta']['elapsed'], self.path),
+                file=out)
+        print("  %-24s %7s %9s %9s %9s %9s" % ('phase (ms)', 'n', 'total', 'p50', 'p99', 'max'),
+                file=out)
+
+        phases = sorted(trace['phases'].items(), key=lambda p: -p[1]['total'])
+        for name, p in phases[:rows]:
+            print("  %-24s %7d %s %s %s %s" % (name, p['n'], ms(p['total']), ms(p.get('p50')),
+                ms(p.get('p99')), ms(p['max'])), file=out)
+
+        if trace['levels']:
+            survivors = ', '.join('%r %d' % (l['query'], l['survivors'])
+                    for l in trace['levels'][-rows:])
+            print("  survivors: %s" % survivors, file=out)
+
+        for i, worker in enumerate(trace['workers'] or []):
+            busy = sum(seconds for _, seconds, _ in worker.values())
+            print("  worker %d: %d calls, %.2fs busy" % (i,
+                sum(n for n, _, _ in worker.values()), busy), file=out)
+
+        if trace['memory']:
+            last = trace['memory'][-1]
+            print("  memory: %dKB traced, %dKB peak" % (last['current_kb'], last['peak_kb']),
+                    file=out)
+
+    def finish(self):
+        self.snapshot('exit')
+        self.report(self.write())
+        if self.memory:
+            tracemalloc.stop()
+
+class Phase(object):
+    "Times a with block"
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.args
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, time.time() - self.start, **self.args)
+
+class NoPhase(object):
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        pass
+
+NO_PHASE = NoPhase()
+
+def phase(name, **args):
+    """
+    Times a with block as the phase `name`, when tracing.  The block gets
+    the phase's args, which it can add to.
+    """
+    if tracer is None:
+        return NO_PHASE
+
+    return tracer.phase(name, **args)
+
+def start(path, memory=False):
+    "Starts tracing to `path`; `memory` also snapshots allocations with tracemalloc"
+    global tracer
+    tracer = Tracer(path, memory)
+    if memory and tracemalloc is None:
+        print("quickfind: tracing memory needs Python 3.4 or later", file=sys.stderr)
+
+    atexit.register(finish)
+    return tracer
+
+def finish():
+    "Writes out the trace, once"
+    global tracer
+    current, tracer = tracer, None
+    if current is not None:
+        current.finish()
+
+def traced(orderer):
+    "Wraps an orderer so its calls are traced, when tracing"
+    if tracer is None:
+        return orderer
+
+    return TracedOrderer(orderer)
+
+class TracedOrderer(Orderer):
+    """
+    Times every call into an orderer and the survivors of each level it
+    pushes.  Worker timings are collected before the orderer is cleaned up,
+    for orderers with workers.
+    """
+
+    def __init__(self, orderer):
+        self.orderer = orderer
+        self.depth = 0
+
+    @property
+    def interrupt(self):
+        return self.orderer.interrupt
+
+    @interrupt.setter
+    def interrupt(self, interrupt):
+        self.orderer.interrupt = interrupt
+
+    def _call(self, name, *args, **fields):
+        start = time.time()
+        try:
+            return getattr(self.orderer, name)(*args)
+        finally:
+            current = tracer
+            if current is not None:
+                current.add('orderer.' + name, start, time.time() - start, **fields)
+
+    def push_query(self, query):
+        start = time.time()
+        try:
+            self.orderer.push_query(query)
+        except Interrupted:
+            self._pushed(query, start, interrupted=True)
+            raise
+
+        self.depth += 1
+        survivors = self.orderer.item_count()
+        self._pushed(query, start, survivors=survivors)
+
+    def _pushed(self, query, start, **fields):
+        current = tracer
+        if current is None:
+            return
+
+        seconds = time.time() - start
+        current.add('orderer.push_query', start, seconds, query=query, depth=self.depth,
+                **fields)
+        if 'survivors' in fields:
+            current.level(query, self.depth, fields['survivors'], seconds)
+
+    def pop_query(self):
+        self.depth -= 1
+        return self._call('pop_query', depth=self.depth)
+
+    def top_items(self, N):
+        return self._call('top_items', N, n=N)
+
+    def item_count(self):
+        return self._call('item_count')
+
+    def total_count(self):
+        return self._call('total_count')
+
+    def extend(self, items):
+        return self._call('extend', items, items=len(items))
+
+    def discard(self, items):
+        return self._call('discard', items, items=len(items))
+
+    def cleanup(self):
+        current = tracer
+        stats = getattr(self.orderer, 'worker_stats', None)
+        if current is not None and stats is not None:
+            current.workers = stats()
+
+        return self._call('cleanup')
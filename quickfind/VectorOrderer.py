@@ -0,0 +1,356 @@
+from itertools import islice
+
+from .Orderer import Orderer, from_window, carried, SAME, NEXT
+from .source.Util import RankerFactory, StringRanker
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def encode(text):
+    "The bytes of a key or term; file names that weren't UTF-8 keep their bytes"
+    if isinstance(text, bytes):
+        return text
+
+    return text.encode('utf-8', 'surrogateescape')
+
+class VectorOrderer(Orderer):
+    """
+    A single process engine for StringRanker-style rankers that scores with
+    NumPy instead of one Python call per item.  Every search key is packed
+    into one NUL separated byte buffer with an array of start offsets; the
+    length and weight parts of the score, which don't depend on the query,
+    are computed once when items are added.
+
+    A query term is found by scanning the buffer for its first byte and
+    narrowing the hits down byte by byte, then mapping hit positions back to
+    items with a binary search over the offsets.  Scores and ordering are
+    the same as STOrderer's.  Levels with few survivors are cheaper to rank
+    in Python, so those fall back to the ranker itself.
+
+    Like STOrderer, levels of several terms keep each survivor's score over
+    all but the last term, so a push only looks for the term being typed.
+    """
+
+    # Buffer bytes per surviving item past which a level is ranked in Python
+    SCAN_RATIO = 400
+
+    def __init__(self, ranker, items):
+        self.ranker = ranker
+        self.items = []
+        self.rankers = [None]
+        self.levels = [None]
+        self.windows = [None]
+
+        self.buf = np.zeros(0, dtype=np.uint8)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.float64)
+        self.roots = np.zeros(0, dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+
+        # Search keys, as the Python ranker takes them with the weights
+        self.keys = []
+        self._pack(items)
+
+        # Ids of discarded items, which no level keeps
+        self.dead = set()
+
+    @staticmethod
+    def supports(ranker):
+        return np is not None and isinstance(ranker, RankerFactory) \
+                and issubclass(ranker.cls, StringRanker)
+
+    def _pack(self, items):
+        "Appends the keys and static score parts of a batch of items"
+        items = list(items)
+        rank = self.ranker('')
+        keys = [rank.key(item) for item in items]
+        encoded = [encode(k) for k in keys]
+
+        offset = len(self.buf) + (1 if len(self.buf) else 0)
+        sizes = np.array([len(e) for e in encoded], dtype=np.int64)
+        starts = offset + np.concatenate(([0], np.cumsum(sizes + 1)[:-1])).astype(np.int64)
+        joined = np.frombuffer(b'\0'.join(encoded), dtype=np.uint8)
+        if len(self.buf) and len(joined):
+            joined = np.concatenate((np.zeros(1, dtype=np.uint8), joined))
+
+        self.buf = np.concatenate((self.buf, joined))
+        self.starts = np.concatenate((self.starts, starts[:len(items)]))
+        self.ends = np.concatenate((self.ends, starts[:len(items)] + sizes))
+        self.lengths = np.concatenate((self.lengths,
+            np.array([len(k) for k in keys], dtype=np.float64)))
+
+        # Computed as the Python rankers do, so scores match to the bit
+        self.roots = np.concatenate((self.roots,
+            np.array([len(k) ** 0.5 for k in keys], dtype=np.float64)))
+
+        self.weights = np.concatenate((self.weights,
+            np.array([rank.weight(item) for item in items], dtype=np.float64)))
+
+        self.keys.extend(keys)
+        self.items.extend(items)
+
+    def _find(self, term):
+        "Item ids containing term, with its prefix and suffix flags"
+        q = np.frombuffer(encode(term), dtype=np.uint8)
+        buf = self.buf
+        if len(q) == 0:
+            everything = np.ones(len(self.items), dtype=bool)
+            return everything, everything, everything
+        elif len(q) > len(buf):
+            return None
+
+        pos = np.flatnonzero(buf[:len(buf) - len(q) + 1] == q[0])
+        for k in range(1, len(q)):
+            pos = pos[buf[pos + k] == q[k]]
+
+        owners = np.searchsorted(self.starts, pos, side='right') - 1
+        n = len(self.items)
+        found = np.zeros(n, dtype=bool)
+        found[owners] = True
+        prefix = np.zeros(n, dtype=bool)
+        prefix[owners[pos == self.starts[owners]]] = True
+        suffix = np.zeros(n, dtype=bool)
+        suffix[owners[pos + len(q) == self.ends[owners]]] = True
+        return found, prefix, suffix
+
+    def _term(self, q):
+        "Which items contain a term, and the term's score for every item"
+        hits = self._find(q)
+        if hits is None:
+            return None
+
+        found, prefix, suffix = hits
+
+        # Don't do more interesting ranking with one character
+        if len(q) == 1:
+            return found, self.lengths
+
+        return found, self.roots - prefix - suffix
+
+    def _scan(self, rank, ids):
+        "Scores every item in one pass per term, keeping those in ids"
+        mask = np.zeros(len(self.items), dtype=bool)
+        mask[ids] = True
+        qs = rank.qs
+        terms = {}
+        for q in sorted(set(qs), key=len, reverse=True):
+            term = self._term(q)
+            if term is None:
+                mask[:] = False
+                break
+
+            terms[q] = term[1]
+            mask &= term[0]
+            if not mask.any():
+                break
+
+        survivors = np.flatnonzero(mask).astype(np.int64)
+        if not len(survivors):
+            empty = np.zeros(0, dtype=np.float64)
+            return survivors, empty, empty if len(qs) > 1 else None
+
+        # Summed in term order, as the Python rankers do
+        agg = np.zeros(len(survivors), dtype=np.float64)
+        for q in qs[:-1]:
+            agg = agg + terms[q][survivors]
+
+        partials = agg if len(qs) > 1 else None
+        if qs:
+            agg = agg + terms[qs[-1]][survivors]
+
+        return survivors, agg + self.weights[survivors], partials
+
+    def _rank(self, rank, ids):
+        "Ranks ids one at a time with the Python ranker"
+        keys, weights = self.keys, self.weights
+        survivors, scores = [], []
+        if len(rank.qs) > 1:
+            rank_terms = rank.rank_terms
+            partials = []
+            for i in ids:
+                split = rank_terms(keys[i])
+                if split is not None:
+                    partial, score = split
+                    survivors.append(i)
+                    scores.append(partial + score + weights[i])
+                    partials.append(partial)
+
+            partials = np.array(partials, dtype=np.float64)
+        else:
+            rank_key = rank.rank_key
+            partials = None
+            for i in ids:
+                score = rank_key(keys[i], weights[i])
+                if score is not None:
+                    survivors.append(i)
+                    scores.append(score)
+
+        return (np.array(survivors, dtype=np.int64),
+                np.array(scores, dtype=np.float64), partials)
+
+    def _carried(self, prev, rank, level):
+        "How `rank` can build on `level`, which `prev` ranked"
+        if level is None:
+            return None
+
+        how = carried(prev, rank)
+        if how is not None and how != SAME and level[2] is None and len(prev.terms) > 1:
+            return None
+
+        return how
+
+    def _carry(self, how, prev, rank, level):
+        "Ranks the survivors of `level` by the last term of `rank` alone"
+        if how == SAME:
+            return level
+
+        ids, _, partials = level
+        if partials is None:
+            partials = np.zeros(len(ids), dtype=np.float64)
+
+        # A new term moves the one before it into the partial sums
+        added = prev.terms[-1] if how == NEXT else None
+        term = rank.terms[-1]
+        if len(ids) * self.SCAN_RATIO < len(self.buf):
+            keys, weights = self.keys, self.weights
+            rank_term = rank.rank_term
+            partials = partials.tolist()
+            keep, scores, sums = [], [], []
+            for k, i in enumerate(ids.tolist()):
+                score = rank_term(term, keys[i])
+                if score is None:
+                    continue
+
+                partial = partials[k]
+                if added is not None:
+                    partial += rank_term(added, keys[i])
+
+                keep.append(k)
+                scores.append(partial + score + weights[i])
+                sums.append(partial)
+
+            keep = np.array(keep, dtype=np.int64)
+            return (ids[keep], np.array(scores, dtype=np.float64),
+                    np.array(sums, dtype=np.float64))
+
+        hits = self._term(term)
+        if hits is None:
+            empty = np.zeros(0, dtype=np.float64)
+            return np.zeros(0, dtype=np.int64), empty, empty
+
+        found, score = hits
+        keep = found[ids]
+        ids, partials = ids[keep], partials[keep]
+        if added is not None:
+            partials = partials + self._term(added)[1][ids]
+
+        return ids, partials + score[ids] + self.weights[ids], partials
+
+    def _level(self, rank, prev, level, ids):
+        "Ranks ids, the survivors of `level`, which `prev` ranked"
+        how = self._carried(prev, rank, level)
+        if how is not None:
+            return self._carry(how, prev, rank, level)
+        elif len(ids) * self.SCAN_RATIO < len(self.buf):
+            return self._rank(rank, ids)
+
+        return self._scan(rank, ids)
+
+    def _ids(self, level):
+        return np.arange(len(self.items)) if level is None else level[0]
+
+    def push_query(self, query):
+        rank = self.ranker(query)
+        level = self.levels[-1]
+        level = self._level(rank, self.rankers[-1], level, self._ids(level))
+        if self.dead:
+            level = self._alive(level)
+
+        self.rankers.append(rank)
+        self.levels.append(level)
+        self.windows.append(None)
+
+    def pop_query(self):
+        self.levels.pop()
+        self.rankers.pop()
+        self.windows.pop()
+
+    def extend(self, items):
+        "Adds a batch of items, ranking it against each query on the stack"
+        start = len(self.items)
+        self._pack(items)
+        # Each level builds on the batch's survivors of the one before
+        prev, batch = None, None
+        ids = np.arange(start, len(self.items))
+        for i in range(1, len(self.levels)):
+            rank = self.rankers[i]
+            how = self._carried(prev, rank, batch)
+            if how is not None:
+                batch = self._carry(how, prev, rank, batch)
+            else:
+                batch = self._rank(rank, ids)
+
+            prev, ids = rank, batch[0]
+            self.levels[i] = tuple(None if old is None else np.concatenate((old, new))
+                    for old, new in zip(self.levels[i], batch))
+
+        self.windows = [None] * len(self.levels)
+
+    def _alive(self, level):
+        ids, scores, partials = level
+        keep = ~np.isin(ids, np.fromiter(self.dead, dtype=np.int64))
+        return ids[keep], scores[keep], None if partials is None else partials[keep]
+
+    def discard(self, items):
+        gone = set(items)
+        dead = self.dead
+        ids = [i for i, item in enumerate(self.items) if item in gone and i not in dead]
+        if not ids:
+            return
+
+        dead.update(ids)
+        self.levels = [None] + [self._alive(level) for level in self.levels[1:]]
+        self.windows = [None] * len(self.levels)
+
+    def _top_items(self, N):
+        top = from_window(self.windows[-1], N, self.item_count())
+        if top is None:
+            level = self.levels[-1]
+            if level is None:
+                dead = self.dead
+                alive = (i for i in range(len(self.items)) if i not in dead)
+                top = [(0, i) for i in islice(alive, N)]
+            else:
+                ids, scores = level[:2]
+                if N < len(scores):
+                    # Keep everything tied with the N'th score so the id
+                    # tie break below stays exact
+                    kth = np.partition(scores, N - 1)[N - 1]
+                    keep = scores <= kth
+                    ids, scores = ids[keep], scores[keep]
+
+                order = np.lexsort((ids, scores))[:N]
+                top = list(zip(scores[order].tolist(), ids[order].tolist()))
+
+            self.windows[-1] = top
+
+        return top
+
+    def top_items(self, N):
+        items = self.items
+        return [items[i] for _, i in self._top_items(N)]
+
+    def item_count(self):
+        if self.levels[-1] is None:
+            return self.total_count()
+
+        return len(self.levels[-1][0])
+
+    def total_count(self):
+        return len(self.items) - len(self.dead)
+
+    def cleanup(self):
+        pass
@@ -1,48 +1,135 @@
-from __future__ import print_function
-import os, sys
-from collections import namedtuple
+import os, mmap
+from array import array
+from collections import namedtuple, OrderedDict
 from .Source import Source
-from itertools import islice
 
 from quickfind.Searcher import Ranker,CString
 from .Util import truncate_middle, truncate_front, highlight
 
-try:
-    import ctags
-except ImportError:
-    ctags = None
-
 ENTRY_FIELDS = ("name", "file", "disp", "pattern", "lineNumber", "kind", "fileScope")
 Entry = namedtuple("Entry", ENTRY_FIELDS)
 
+if bytes is str:
+    decode = lambda line: line
+else:
+    decode = lambda line: line.decode('utf-8', 'replace')
+
 class CtagsSource(Source):
-    def __init__(self, filename):
-        if ctags is None:
-            print("`ctags` not found.  Ensure library 'python-ctags' is installed")
-            sys.exit(1)
+    """
+    Reads a tags file in the extended format written by exuberant and 
+    universal ctags.  The file is memory mapped and parsed a chunk at a 
+    time as the stream is consumed.
+    """
 
-        self.tag_file = ctags.CTags(filename)
+    # Bytes parsed at a time
+    CHUNK = 1 << 20
+
+    def __init__(self, filename):
+        self.filename = filename
         self.base_dir = os.path.split(filename)[0]
 
-    def _entry_to_Entry(self, entry):
-        ed = dict((f, entry[f]) for f in ENTRY_FIELDS)
-        ed['file'] = os.path.abspath(os.path.join(self.base_dir, ed['file']))
-        return Entry(**ed)
+        # tags file path -> absolute path, shared by every tag in the file
+        self.paths = {}
+
+    def path(self, name):
+        path = self.paths.get(name)
+        if path is None:
+            path = os.path.abspath(os.path.join(self.base_dir, name))
+            path = self.paths[name] = self.paths.setdefault(path, path)
+
+        return path
+
+    def _lines(self):
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            pos, size = 0, len(buf)
+            while pos < size:
+                end = buf.rfind(b'\n', pos, pos + self.CHUNK) + 1
+                if end <= pos:
+                    # A line longer than a chunk, or no final newline
+                    end = buf.find(b'\n', pos + self.CHUNK) + 1 or size
+
+                chunk = decode(buf[pos:end])
+                if '\r' in chunk:
+                    chunk = chunk.replace('\r\n', '\n')
+
+                for line in chunk.split('\n'):
+                    if line:
+                        yield line
+                pos = end
+        finally:
+            buf.close()
 
     def _query(self):
-        entry = ctags.TagEntry()
-        if self.tag_file.first(entry):
-            yield self._entry_to_Entry(entry)
-            while self.tag_file.next(entry):
-                yield self._entry_to_Entry(entry)
+        """
+        Entries for each tag, skipping pseudo tags.  Lines are
+            name<TAB>file<TAB>address[;"<TAB>extension fields]
+        where the address is a line number or a search pattern.
+        """
+        path = self.path
+        for line in self._lines():
+            if line.startswith('!_'):
+                continue
+
+            fields = line.split('\t', 2)
+            if len(fields) < 3:
+                continue
+
+            name, filename, rest = fields
+
+            # The address ends at ;" when extension fields follow
+            i = rest.find(';"\t')
+            if i < 0 and rest.endswith(';"'):
+                i = len(rest) - 2
+
+            if i < 0:
+                pattern, extensions = rest, ()
+            else:
+                pattern, extensions = rest[:i], rest[i + 3:].split('\t')
+
+            line_number = int(pattern) if pattern.isdigit() else 0
+            kind, file_scope = '', 0
+            for ext in extensions:
+                key, sep, value = ext.partition(':')
+                if not sep:
+                    # A bare kind
+                    kind = key
+                elif key == 'kind':
+                    kind = value
+                elif key == 'line' and value.isdigit():
+                    line_number = int(value)
+                elif key == 'file':
+                    file_scope = 1
+
+            yield Entry(name, path(filename), None, pattern, line_number, kind, file_scope)
 
     def fetch(self):
         return list(self._query())
 
+    def stream(self):
+        return self._query()
+
 class CtagsFormatter(object):
+    """
+    Shows each tag with the line it's on.  Lines are found through a table
+    of line offsets per source file, kept for the most recently shown files,
+    and read for a whole screen of tags at a time with prefetch().
+    """
+
+    # Source files whose line offsets are kept
+    MAX_FILES = 32
+
+    # Tags whose lines are kept
+    MAX_DETAILS = 4096
     
     def __init__(self, columns, surrounding=True):
-        self.detail_cache = {}
+        self.detail_cache = OrderedDict()
+        self.offsets = OrderedDict()
         self.surrounding = surrounding
 
     def __call__(self, entry, query, dims):
@@ -68,8 +155,82 @@ class CtagsFormatter(object):
         res.append(details)
         return res
 
-    def read_line_at(self, f, num):
-        return next(islice(f, num - 1, num), None)
+    def line_offsets(self, path):
+        "Offset of the start of each line in a file, or None if it can't be read"
+        offsets = self.offsets.pop(path, None)
+        if offsets is None:
+            try:
+                offsets = self.read_offsets(path)
+            except (IOError, OSError, ValueError):
+                offsets = None
+
+        self.offsets[path] = offsets
+        if len(self.offsets) > self.MAX_FILES:
+            self.offsets.popitem(last=False)
+
+        return offsets
+
+    def read_offsets(self, path):
+        offsets = array('L', [0])
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return offsets
+
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            find, append = buf.find, offsets.append
+            pos = find(b'\n')
+            while pos >= 0:
+                append(pos + 1)
+                pos = find(b'\n', pos + 1)
+        finally:
+            buf.close()
+
+        return offsets
+
+    def read_lines(self, path, numbers):
+        "The lines at each of `numbers` in a file, None past its end"
+        offsets = self.line_offsets(path)
+        if offsets is None:
+            return None
+
+        lines = []
+        with open(path, 'rb') as f:
+            for num in numbers:
+                if num > len(offsets):
+                    lines.append(None)
+                else:
+                    f.seek(offsets[num - 1])
+                    line = f.readline()
+                    lines.append(decode(line) if line else None)
+
+        return lines
+
+    def prefetch(self, entries):
+        "Reads the lines of all the tags not cached yet, opening each file once"
+        by_file = OrderedDict()
+        for entry in entries:
+            # Files have no line, and tags without a line number show their pattern
+            if entry.kind != 'F' and entry.lineNumber != 0 and entry not in self.detail_cache:
+                by_file.setdefault(entry.file, []).append(entry)
+
+        for path, group in by_file.items():
+            try:
+                lines = self.read_lines(path, [e.lineNumber for e in group])
+            except (IOError, OSError):
+                lines = None
+
+            for i, entry in enumerate(group):
+                if lines is None:
+                    details = None
+                else:
+                    line = lines[i]
+                    details = (entry.pattern if line is None else line).strip()
+
+                self.detail_cache[entry] = details
+                if len(self.detail_cache) > self.MAX_DETAILS:
+                    self.detail_cache.popitem(last=False)
 
     def get_details(self, entry):
         # If a file, print nothing
@@ -81,33 +242,38 @@ class CtagsFormatter(object):
             return entry.pattern
 
         if entry not in self.detail_cache:
-            lineNum = entry.lineNumber
-            if not os.path.isfile(entry.file):
-                self.detail_cache[entry] = None
-            else:
-                with file(entry.file) as f:
-                    response = self.read_line_at(f, lineNum)
-                    if response is None:
-                        response = entry.pattern
-                    self.detail_cache[entry] = response.strip()
-        
-        return self.detail_cache[entry]
+            self.prefetch([entry])
+
+        # Most recently used last
+        details = self.detail_cache.pop(entry)
+        self.detail_cache[entry] = details
+        return details
 
     def indent(self, s, indent):
         return s.rjust(len(s) + indent)
 
 class CtagsRanker(Ranker):
 
+    keyed = True
+
     def __init__(self, query):
         self.q = query.lower()
+        self.terms = [self.q]
 
-    def rank(self, item):
-        sname = item.name.lower()
+    def key(self, item):
+        return item.name.lower()
+
+    def weight(self, item):
+        return item.file.count(os.sep) ** 0.5
+
+    def rank_key(self, sname, weight):
         if self.q not in sname:
             return None
 
-        score = len(item.name) - len(self.q)
-        score += item.file.count(os.sep) ** 0.5
+        score = len(sname) - len(self.q)
+        score += weight
         score -= 1.0 if sname.startswith(self.q) else 0.0
         return score
 
+    def rank(self, item):
+        return self.rank_key(self.key(item), self.weight(item))
@@ -0,0 +1,100 @@
+import os, time, hashlib, tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'quickfind')
+
+def cache_path(dirs, git_ignore):
+    "Each distinct set of start directories gets its own index file"
+    key = '\0'.join(sorted(os.path.abspath(d) for d in dirs))
+    key += '\0%s' % bool(git_ignore)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), digest + '.idx')
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class DirectoryIndex(object):
+    """
+    Persisted results of a previous walk.  Entries are keyed by absolute
+    directory path and hold:
+
+        (mtime, gitignore mtime, kept dirs, symlinked dirs, kept files)
+
+    The kept names are what survived .gitignore filtering, so an unchanged
+    directory can be reused without listing it or parsing any filters.
+    """
+    VERSION = 1
+
+    def __init__(self, path, entries=None, roots=None, saved=0):
+        self.path = path
+        self.entries = entries or {}
+        self.roots = roots or {}
+        self.saved = saved
+
+        # Entries touched during the current walk; swapped in on save so
+        # deleted directories fall out of the index
+        self.fresh = {}
+        self.fresh_roots = {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                version, entries, roots, saved = pickle.load(f)
+        except Exception:
+            return cls(path)
+
+        if version != cls.VERSION:
+            return cls(path)
+
+        return cls(path, entries, roots, saved)
+
+    def get(self, abspath, mtime):
+        entry = self.entries.get(abspath)
+        if entry is None or entry[0] != mtime:
+            return None
+
+        # Racy entries: the directory may have changed again within the
+        # resolution of its mtime after we recorded it.
+        if mtime >= self.saved - 1:
+            return None
+
+        return entry
+
+    def put(self, abspath, entry):
+        self.fresh[abspath] = entry
+
+    def root_stamp(self, abspath):
+        return self.roots.get(abspath)
+
+    def put_root(self, abspath, stamp):
+        self.fresh_roots[abspath] = stamp
+
+    def save(self):
+        self.entries, self.fresh = self.fresh, {}
+        self.roots, self.fresh_roots = self.fresh_roots, {}
+        self.saved = time.time()
+
+        dirname = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            fd, tmp = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                data = (self.VERSION, self.entries, self.roots, self.saved)
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # A missing cache only costs us a full walk next time
+            pass
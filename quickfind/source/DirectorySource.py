@@ -1,101 +1,333 @@
-import os, re, fnmatch, sys
-from collections import namedtuple
+import os, re, fnmatch, sys, time
 from itertools import islice
 
 from .Source import Source
 from quickfind.Searcher import Ranker, CString
 from .Util import truncate_middle, rec_dir_up, highlight, StringRanker, simpleFormatter 
+from .DirectoryIndex import DirectoryIndex, cache_path, get_mtime
+from .Walker import walk, listdir
+from .Watcher import new_watcher, PollingWatcher
+from quickfind import Trace
 
-try:
-    import fsnix.util as util
-    walk = util.walk
-except ImportError:
-    walk = os.walk
+class File(object):
+    """
+    A file or directory, by the label of the directory it's in and its
+    name.  Items from one directory all share its label, and the lowered
+    name is only worked out when asked for, so a record costs little more
+    than its name.  Unpacks, like a tuple, to (dir, name).
+    """
+    __slots__ = ('dir', 'name')
 
-if sys.version_info.major >= 3:
-    xrange = range
+    def __init__(self, dir, name):
+        self.dir = dir
+        self.name = name
+
+    @property
+    def sname(self):
+        return self.name.lower()
+
+    def __iter__(self):
+        yield self.dir
+        yield self.name
+
+    def __eq__(self, other):
+        return isinstance(other, File) and self.name == other.name and self.dir == other.dir
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.dir, self.name))
+
+    def __reduce__(self):
+        return File, (self.dir, self.name)
+
+    def __repr__(self):
+        return "File(dir=%r, name=%r)" % (self.dir, self.name)
 
-File = namedtuple("File", "dir,name,sname")
 class DirectorySource(Source):
 
-    def __init__(self, dirs=".", ignore_directories=True, ignore_files=True, git_ignore=True):
+    def __init__(self, dirs=".", ignore_directories=True, ignore_files=True, 
+            git_ignore=True, cache=None, threads=8, base=None, watch=False):
         self.ignore_directories = ignore_directories
         self.ignore_files = ignore_files
         self.git_ignore = git_ignore
         self.startDirs = dirs
+        self.cache = cache
+        self.index = None
+        self.gi_filters = {}
+        self.threads = threads
 
-    def find_parent_gis(self, dir):
-        dirs = rec_dir_up(os.path.abspath(dir))
-        next(dirs)
-        filters = []
-        for dirname in dirs:
-            pgi = os.path.join(dirname, '.gitignore')
-            if os.path.isfile(pgi):
-                filters.append((dirname, GitIgnoreFilter(dirname, '.gitignore')))
+        # Directory relative start dirs are resolved against, if not the cwd
+        self.base = base
 
-        return list(reversed(filters))
+        # With `watch`, every directory walked is remembered as
+        #   abspath -> (dirname, inherited .gitignore dir, item names, subdirs)
+        # so updates() can rescan just the ones that change
+        self.tree = {} if watch else None
+        self.watcher = new_watcher() if watch else None
 
     def fetch(self):
-        # optimize for the base case
-        sd = set()
-        lst = []
-        if len(self.startDirs) == 1:
-            return self.fetchDir(self.startDirs[0], sd)
+        return list(self.stream())
+
+    def stream(self):
+        if self.cache is not None:
+            return self.streamIndexed()
+
+        return self.streamDirs()
+
+    def abspath(self, d):
+        if self.base is not None:
+            d = os.path.join(self.base, d)
+
+        return os.path.abspath(d)
+
+    def streamDirs(self):
+        roots = []
+        for d in self.startDirs:
+            root = self.abspath(d)
+            fdir, _ = self.find_parent_stamp(root)
+            roots.append((d, root, fdir, False))
 
+        return self.walkDirs(roots, self.scanDir)
+
+    def streamIndexed(self):
+        path = self.cache
+        if path is True:
+            path = cache_path([self.abspath(d) for d in self.startDirs], self.git_ignore)
+
+        self.index = index = DirectoryIndex.load(path)
+        roots = []
         for d in self.startDirs:
-            lst.extend(self.fetchDir(d, sd))
+            root = self.abspath(d)
+            fdir, stamp = self.find_parent_stamp(root)
+            roots.append((d, root, fdir, index.root_stamp(root) != stamp))
+            index.put_root(root, stamp)
 
-        return lst
+        for f in self.walkDirs(roots, self.scanIndexed):
+            yield f
 
-    # Walk interface is annoying: to remove dirs, you have to del them from
-    # the array
-    def delDirs(self, dirs, f):
-        for i in xrange(len(dirs) - 1, -1, -1):
-            if not f(dirs[i]):
-                del dirs[i]
+        index.save()
 
-    def fetchDir(self, d, seenDirs):
-        lst = []
-        ap = os.path.abspath
-        filters = self.find_parent_gis(d) if self.git_ignore else []
-        for dirname, dirs, filenames in walk(d):
-            abspath = ap(dirname)
-            if abspath in seenDirs:
-                self.delDirs(dirs, lambda x: False)
-                continue
+    def walkDirs(self, roots, scan):
+        """
+        Walks the start directories in parallel.  Each node is (dirname, 
+        abspath, dir of the nearest .gitignore, stale) and is seen only once, 
+        even when start directories overlap.
+        """
+        seenDirs = set()
 
-            seenDirs.add(abspath)
+        def expand(node, result):
+            dirname, abspath = node[0], node[1]
+            fdir, stale, dirs, links, files = result
 
             names = []
             if not self.ignore_files:
-                names = filenames
+                names.extend(files)
             if not self.ignore_directories:
                 names.extend(dirs)
 
-            if self.git_ignore and '.gitignore' in filenames:
-                gif = GitIgnoreFilter(abspath, '.gitignore')
-                filters.append((abspath, gif))
-
-            while filters:
-                path, _ = filters[-1]
-                if abspath.startswith(path): break
-                filters.pop()
-
-            fltr = filters[-1][1] if filters else None
-            
-            if fltr is None:
-                files = (File(dirname, name, name.lower()) for name in names)
-            else:
-                files = (File(dirname, name, name.lower()) 
-                        for name in names if fltr(name, abspath))
+            # Sorted, so the walk comes out in the same order on every run
+            names.sort()
+            items = [File(dirname, name) for name in names]
 
-            lst.extend(files)
-
-            # have to delete the names manually
-            if fltr is not None:
-                self.delDirs(dirs, lambda d: fltr(d, abspath))
+            children = []
+            links = set(links)
+            for name in sorted(dirs):
+                child = os.path.join(abspath, name)
+                if name in links or child in seenDirs:
+                    continue
 
-        return lst
+                seenDirs.add(child)
+                children.append((os.path.join(dirname, name), child, fdir, stale))
+
+            if self.tree is not None:
+                subdirs = set(c[1][len(abspath) + 1:] for c in children)
+                self.tree[abspath] = (dirname, node[2], set(names), subdirs)
+                self.watch_dir(abspath)
+
+            return items, children
+
+        nodes = []
+        for node in roots:
+            if node[1] not in seenDirs:
+                seenDirs.add(node[1])
+                nodes.append(node)
+
+        return walk(nodes, scan, expand, self.threads)
+
+    def watch_dir(self, abspath):
+        try:
+            self.watcher.add(abspath)
+        except OSError:
+            # Most likely out of inotify watches
+            self.watcher.close()
+            self.watcher = PollingWatcher()
+            for path in self.tree:
+                self.watcher.add(path)
+
+    def updates(self):
+        """
+        Rescans the directories that changed since the last call, returning
+        the (added, removed) items.  A changed .gitignore rescans everything
+        beneath it.  Only call this once the walk has finished.
+        """
+        changed = self.watcher.changed()
+        if changed is None:
+            # Events were dropped; check everything
+            dirs, ignores = set(self.tree), set()
+        else:
+            dirs, ignores = changed
+
+        for path in ignores:
+            self.gi_filters.pop(path, None)
+            prefix = path + os.sep
+            dirs.update(p for p in self.tree if p == path or p.startswith(prefix))
+
+        added, removed = [], []
+        for path in sorted(dirs, key=lambda p: p.count(os.sep)):
+            a, r = self.rescan(path)
+            added.extend(a)
+            removed.extend(r)
+
+        return added, removed
+
+    def close(self):
+        "Stops watching; updates() can't be called after"
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def rescan(self, abspath):
+        "The (added, removed) items of a directory since it was last listed"
+        entry = self.tree.get(abspath)
+        if entry is None:
+            return [], []
+
+        dirname, pfdir, names, subdirs = entry
+        try:
+            fdir, dirs, links, files = self.filterDir(abspath, pfdir, *listdir(abspath))
+        except OSError:
+            return [], self.drop(abspath)
+
+        new_names = set()
+        if not self.ignore_files:
+            new_names.update(files)
+        if not self.ignore_directories:
+            new_names.update(dirs)
+
+        added = [File(dirname, n) for n in new_names - names]
+        removed = [File(dirname, n) for n in names - new_names]
+
+        new_subdirs = set(dirs) - set(links)
+        for name in subdirs - new_subdirs:
+            removed.extend(self.drop(os.path.join(abspath, name)))
+
+        for name in new_subdirs:
+            child = os.path.join(abspath, name)
+            if name not in subdirs:
+                node = (os.path.join(dirname, name), child, fdir, False)
+                added.extend(self.walkDirs([node], self.scanDir))
+            elif child in self.tree and self.tree[child][1] != fdir:
+                # Its inherited .gitignore changed
+                c = self.tree[child]
+                self.tree[child] = (c[0], fdir, c[2], c[3])
+
+        self.tree[abspath] = (dirname, pfdir, new_names, new_subdirs)
+        return added, removed
+
+    def drop(self, abspath):
+        "Forgets a directory and everything beneath it, returning its items"
+        entry = self.tree.pop(abspath, None)
+        if entry is None:
+            return []
+
+        self.watcher.remove(abspath)
+        dirname, _, names, subdirs = entry
+        removed = [File(dirname, n) for n in names]
+        for name in subdirs:
+            removed.extend(self.drop(os.path.join(abspath, name)))
+
+        return removed
+
+    def get_filter(self, dirname):
+        "Parses .gitignore files only when a directory actually needs them"
+        fltr = self.gi_filters.get(dirname)
+        if fltr is None:
+            fltr = self.gi_filters[dirname] = GitIgnoreFilter(dirname, '.gitignore')
+
+        return fltr
+
+    def find_parent_stamp(self, abspath):
+        "Nearest .gitignore above the start directory and the mtimes of all of them"
+        if not self.git_ignore:
+            return None, ()
+
+        dirs = rec_dir_up(abspath)
+        next(dirs)
+        stamp = []
+        for dirname in dirs:
+            mtime = get_mtime(os.path.join(dirname, '.gitignore'))
+            if mtime is not None:
+                stamp.append((dirname, mtime))
+
+        nearest = stamp[0][0] if stamp else None
+        return nearest, tuple(stamp)
+
+    def filterDir(self, abspath, fdir, dirs, links, files):
+        "Applies the nearest .gitignore, which may be the directory's own"
+        if self.git_ignore and '.gitignore' in files:
+            fdir = abspath
+
+        if fdir is not None:
+            start = time.time()
+            fltr = self.get_filter(fdir)
+            dirs = [d for d in dirs if fltr(d, abspath)]
+            files = [f for f in files if fltr(f, abspath)]
+            links = [l for l in links if fltr(l, abspath)]
+            if Trace.tracer is not None:
+                Trace.tracer.tally('walk.gitignore', time.time() - start)
+
+        return fdir, dirs, links, files
+
+    def scanDir(self, node):
+        _, abspath, fdir, _ = node
+        fdir, dirs, links, files = self.filterDir(abspath, fdir, *listdir(abspath))
+        return fdir, False, dirs, links, files
+
+    def scanIndexed(self, node):
+        """
+        Reuses the index entry for a directory if its mtime hasn't changed 
+        since the last run.  Changing a .gitignore invalidates the decisions 
+        for everything beneath it.
+        """
+        _, abspath, fdir, stale = node
+        index = self.index
+        mtime = os.stat(abspath).st_mtime
+
+        entry = None if stale else index.get(abspath, mtime)
+        if entry is not None and entry[1] is not None:
+            if get_mtime(os.path.join(abspath, '.gitignore')) != entry[1]:
+                entry = None
+
+        if entry is None:
+            old = index.entries.get(abspath)
+            gdir, dirs, links, files = self.filterDir(abspath, fdir, *listdir(abspath))
+            gi_mtime = None
+            if gdir == abspath:
+                gi_mtime = get_mtime(os.path.join(abspath, '.gitignore'))
+
+            entry = (mtime, gi_mtime, dirs, links, files)
+
+            # Filters below here changed; re-derive the whole subtree
+            if old is None or old[1] != gi_mtime:
+                stale = True
+
+        index.put(abspath, entry)
+        _, gi_mtime, dirs, links, files = entry
+        if gi_mtime is not None:
+            fdir = abspath
+
+        return fdir, stale, dirs, links, files
 
 class GitIgnoreFilter(object):
     # Optimization
@@ -169,16 +401,19 @@ class GitIgnoreFilter(object):
 
         return True
 
-def ranker(inc_path):
+# The ranker lowers parts itself, once per item
+def name_part(item):
+    return item.name
 
-    def rank(self, item):
-        if self.inc_path:
-            return os.path.join(item.dir.lower(), item.sname)
-        else:
-            return item.sname
+def path_part(item):
+    return os.path.join(item.dir, item.name)
+
+def depth_weight(item):
+    return item.dir.count(os.sep) ** 0.5
 
-    weight = lambda _, s: s.dir.count(os.sep) ** 0.5
-    return StringRanker.new(weight, inc_path=inc_path, get_part=rank)
+def ranker(inc_path):
+    get_part = path_part if inc_path else name_part
+    return StringRanker.new(depth_weight, get_part=get_part)
 
 def dirFormatter(f, query, dims):
     return simpleFormatter(os.path.join(f.dir, f.name), query, dims)
@@ -0,0 +1,433 @@
+import os, mmap, struct, subprocess
+from bisect import bisect_left
+
+from .Source import Source
+from .DirectorySource import DirectorySource, File
+from quickfind import Trace
+
+# signature, version, entry count
+HEADER = struct.Struct('>4sII')
+
+# mode and flags of an entry; the stat data and object id are skipped
+ENTRY = struct.Struct('>24xI32xH')
+# and, in version 4, the first byte of the name
+ENTRY_V4 = struct.Struct('>24xI32xHB')
+XFLAGS = struct.Struct('>H')
+EXTENSION = struct.Struct('>4sI')
+
+# Trailing checksum
+HASH_SIZE = 20
+
+NAME_MASK = 0xfff
+EXTENDED = 0x4000
+STAGE = 0x3000
+SKIP_WORKTREE = 0x4000
+
+S_IFMT = 0o170000
+S_IFDIR = 0o040000
+S_IFGITLINK = 0o160000
+
+fsdecode = getattr(os, 'fsdecode', lambda path: path)
+fsencode = getattr(os, 'fsencode', lambda path: path)
+
+class GitIndexError(Exception):
+    pass
+
+def find_repo(path):
+    "The work tree containing `path` and the path of its index, or None"
+    while True:
+        dotgit = os.path.join(path, '.git')
+        if os.path.isdir(dotgit):
+            return path, os.path.join(dotgit, 'index')
+
+        if os.path.isfile(dotgit):
+            # Worktrees and submodules point at their git dir
+            with open(dotgit) as f:
+                line = f.readline().strip()
+            if line.startswith('gitdir:'):
+                gitdir = os.path.join(path, line[len('gitdir:'):].strip())
+                return path, os.path.join(gitdir, 'index')
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def read_index(path):
+    """
+    Reads the paths in a git index, versions 2 to 4, returning them sorted
+    as (files, submodules).  Paths are bytes, relative to the work tree and
+    '/' separated.  Entries not checked out (sparse checkouts) are left
+    out, as are the extra stages of conflicted paths.
+    """
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        # Nothing has been added yet
+        return [], []
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], []
+
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if size < HEADER.size + HASH_SIZE:
+            raise GitIndexError("%s is truncated" % path)
+
+        signature, version, count = HEADER.unpack_from(buf, 0)
+        if signature != b'DIRC':
+            raise GitIndexError("%s is not a git index" % path)
+        if version not in (2, 3, 4):
+            raise GitIndexError("Unsupported index version %d" % version)
+
+        read = read_entries_v4 if version == 4 else read_entries
+        files, submodules, pos = read(buf, count)
+        end = size - HASH_SIZE
+        while pos + EXTENSION.size <= end:
+            name, length = EXTENSION.unpack_from(buf, pos)
+            if name == b'link':
+                # Most entries live in a shared index
+                raise GitIndexError("Split indexes are not supported")
+            pos += EXTENSION.size + length
+
+        return files, submodules
+    except struct.error:
+        raise GitIndexError("%s is truncated" % path)
+    finally:
+        buf.close()
+
+def read_entries(buf, count):
+    """
+    Reads version 2 and 3 entries, returning the files, the submodules and
+    the offset just past them.
+    """
+    unpack_entry = ENTRY.unpack_from
+    files, submodules = [], []
+    append = files.append
+    pos = HEADER.size
+    last = None
+    for _ in range(count):
+        mode, flags = unpack_entry(buf, pos)
+        start = pos + ENTRY.size
+        skip = False
+        if flags & EXTENDED:
+            skip = XFLAGS.unpack_from(buf, start)[0] & SKIP_WORKTREE
+            start += XFLAGS.size
+
+        length = flags & NAME_MASK
+        end = buf.find(b'\0', start) if length == NAME_MASK else start + length
+        name = buf[start:end]
+
+        # NUL padded to a multiple of eight bytes
+        pos += (end - pos + 8) & ~7
+
+        if flags & STAGE and name == last:
+            continue
+
+        last = name
+        if skip:
+            continue
+
+        kind = mode & S_IFMT
+        if kind == S_IFGITLINK:
+            submodules.append(name)
+        elif kind != S_IFDIR:
+            # Sparse indexes also hold directories not checked out
+            append(name)
+
+    return files, submodules, pos
+
+def read_entries_v4(buf, count):
+    "As read_entries, for version 4's prefix compressed names"
+    unpack_entry = ENTRY_V4.unpack_from
+    find = buf.find
+    files, submodules = [], []
+    append = files.append
+    pos = HEADER.size
+    last = b''
+    for _ in range(count):
+        mode, flags, c = unpack_entry(buf, pos)
+        start = pos + ENTRY_V4.size
+        skip = False
+        if flags & EXTENDED:
+            skip = XFLAGS.unpack_from(buf, start - 1)[0] & SKIP_WORKTREE
+            c = ord(buf[start + 1:start + 2])
+            start += XFLAGS.size
+
+        # Names drop a number of bytes from the end of the last one and 
+        # add a suffix
+        strip = c & 0x7f
+        while c & 0x80:
+            c = ord(buf[start:start + 1])
+            start += 1
+            strip = ((strip + 1) << 7) | (c & 0x7f)
+
+        end = find(b'\0', start)
+        name = last[:len(last) - strip] + buf[start:end]
+        pos = end + 1
+
+        if flags & STAGE and name == last:
+            continue
+
+        last = name
+        if skip:
+            continue
+
+        kind = mode & S_IFMT
+        if kind == S_IFGITLINK:
+            submodules.append(name)
+        elif kind != S_IFDIR:
+            # Sparse indexes also hold directories not checked out
+            append(name)
+
+    return files, submodules, pos
+
+def within(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+def beneath(paths, prefix):
+    "The sorted `paths` under `prefix`, relative to it and decoded"
+    if prefix:
+        # '0' sorts right after '/'
+        lo = bisect_left(paths, prefix)
+        hi = bisect_left(paths, prefix[:-1] + b'0', lo)
+        n = len(prefix)
+        paths = [p[n:] for p in paths[lo:hi]]
+
+    if not paths:
+        return []
+
+    # One decode rather than one per path
+    return fsdecode(b'\0'.join(paths)).split('\0')
+
+def listed(prefix, proc):
+    "The paths a `git ls-files -z` run printed, under `prefix`, or None if it failed"
+    if proc is None:
+        return None
+
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+
+    if not out:
+        return []
+
+    return [prefix + f for f in fsdecode(out.rstrip(b'\0')).split('\0')]
+
+class GitIndexSource(Source):
+    """
+    Lists the files git tracks under the start directories straight from
+    the repository's index, without walking the tree.  Checked out
+    submodules are listed from their own indexes.  Files deleted from the
+    work tree, as git reports them, are left out.  With `untracked`, files
+    git would not ignore are added, as listed by git itself; they follow
+    the tracked ones.  Directories are those holding listed files, plus
+    submodules.
+    """
+
+    def __init__(self, dirs=".", ignore_directories=True, ignore_files=True,
+            untracked=False, base=None):
+        self.startDirs = dirs
+        self.ignore_directories = ignore_directories
+        self.ignore_files = ignore_files
+        self.untracked = untracked
+        self.base = base
+
+    def fetch(self):
+        return list(self.stream())
+
+    def abspath(self, d):
+        if self.base is not None:
+            d = os.path.join(self.base, d)
+
+        return os.path.abspath(d)
+
+    def stream(self):
+        """
+        Reads the indexes before returning, raising GitIndexError if a start
+        directory isn't in a work tree or its index can't be read.
+        """
+        starts = []
+        for d in self.startDirs:
+            path = self.abspath(d)
+            if not any(within(path, s) for _, s in starts):
+                starts.append((d, path))
+
+        indexes = {}
+        listings = []
+        for label, path in starts:
+            repo = find_repo(path)
+            if repo is None:
+                raise GitIndexError("%s is not in a git work tree" % label)
+
+            root, index = repo
+            if root not in indexes:
+                with Trace.phase('git.index', path=index) as args:
+                    indexes[root] = read_index(index)
+                    args['entries'] = len(indexes[root][0])
+
+            # Start directories inside this one list their own files
+            skip = [os.path.relpath(s, path).replace(os.sep, '/') + '/'
+                    for _, s in starts if s != path and within(s, path)]
+
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            prefix = fsencode('' if rel == '.' else rel + '/')
+            files, submodules = indexes[root]
+            files, submodules = beneath(files, prefix), beneath(submodules, prefix)
+            procs = self.start_listings('', path)
+            for sub in submodules:
+                files.extend(self.submodule(path, sub, procs))
+
+            listings.append((label, path, files, submodules, skip, procs))
+
+        return self.items(listings)
+
+    def start_listings(self, prefix, path):
+        """
+        Starts git listing the files deleted under `path` and, with
+        `untracked`, those it doesn't track; {option: [(prefix, proc)]}
+        """
+        procs = {'--deleted': [(prefix, self.ls_files(path, '--deleted'))]}
+        if self.untracked:
+            procs['--others'] = [(prefix, self.ls_files(path, '--others', '--exclude-standard'))]
+
+        return procs
+
+    def submodule(self, top, sub, procs):
+        """
+        The files of the submodule at `sub` under the directory `top`, and
+        of any submodules inside it, as paths relative to `top`.  Submodules
+        that aren't checked out hold nothing.  Its listings are added to
+        `procs`.
+        """
+        path = os.path.join(top, *sub.split('/'))
+        if not os.path.exists(os.path.join(path, '.git')):
+            return []
+
+        _, index = find_repo(path)
+        with Trace.phase('git.index', path=index) as args:
+            files, submodules = read_index(index)
+            args['entries'] = len(files)
+
+        prefix = sub + '/'
+        files = [prefix + f for f in beneath(files, b'')]
+        for option, started in self.start_listings(prefix, path).items():
+            procs[option].extend(started)
+
+        for inner in beneath(submodules, b''):
+            files.extend(self.submodule(top, prefix + inner, procs))
+
+        return files
+
+    def ls_files(self, path, *options):
+        "Starts `git ls-files` listing the files under `path` that `options` pick"
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.Popen(['git', 'ls-files', '-z'] + list(options),
+                        cwd=path, stdout=subprocess.PIPE, stderr=devnull)
+        except OSError:
+            # No git to ask
+            return None
+
+    def present(self, path, files, procs):
+        """
+        `files` less those git lists as deleted.  If it couldn't say, each
+        file is looked for instead.
+        """
+        with Trace.phase('git.deleted'):
+            deleted = [listed(prefix, proc) for prefix, proc in procs]
+
+        if any(d is None for d in deleted):
+            return [f for f in files if os.path.lexists(os.path.join(path, *f.split('/')))]
+
+        gone = set()
+        for d in deleted:
+            gone.update(d)
+
+        return [f for f in files if f not in gone] if gone else files
+
+    def items(self, listings):
+        # Directory labels and the directories listed so far, per start
+        state = [({'': label}, set([''])) for label, _, _, _, _, _ in listings]
+        for (labels, seen), (_, path, files, submodules, skip, procs) in zip(state, listings):
+            files = self.present(path, files, procs['--deleted'])
+            for item in self.files(labels, seen, files, submodules, skip):
+                yield item
+
+        for (labels, seen), (_, _, _, _, skip, procs) in zip(state, listings):
+            for prefix, proc in procs.get('--others', []):
+                with Trace.phase('git.untracked'):
+                    files = listed(prefix, proc)
+
+                if files:
+                    for item in self.files(labels, seen, files, [], skip):
+                        yield item
+
+    def files(self, labels, seen, files, submodules, skip):
+        "Items for '/' separated paths relative to a start directory"
+        last = None
+        for path in files:
+            if skip and any(path.startswith(s) for s in skip):
+                continue
+
+            d, _, name = path.rpartition('/')
+            if d != last:
+                last = d
+                dirlabel = self.label(labels, d)
+                if not self.ignore_directories:
+                    for item in self.dirs(labels, seen, d):
+                        yield item
+
+            if not self.ignore_files:
+                yield File(dirlabel, name)
+
+        if not self.ignore_directories:
+            # A submodule is a directory in the work tree
+            for path in submodules:
+                if not (skip and any(path.startswith(s) for s in skip)):
+                    for item in self.dirs(labels, seen, path):
+                        yield item
+
+    def label(self, labels, d):
+        dirlabel = labels.get(d)
+        if dirlabel is None:
+            dirlabel = labels[d] = os.path.join(labels[''], *d.split('/'))
+
+        return dirlabel
+
+    def dirs(self, labels, seen, d):
+        "Items for `d` and the directories above it not seen yet"
+        new = []
+        while d not in seen:
+            seen.add(d)
+            new.append(d)
+            d = d.rpartition('/')[0]
+
+        for d in reversed(new):
+            parent, _, name = d.rpartition('/')
+            yield File(self.label(labels, parent), name)
+
+def stream_files(dirs, file_type, git_ignore=True, untracked=True, walk=False, base=None,
+        **walk_options):
+    """
+    The items of a file search, and a callable reporting changes to them or
+    None.  Files are listed from the git index when `git_ignore` is set, the
+    start directories are in a work tree and a `walk` wasn't asked for;
+    otherwise a DirectorySource walks them, given `walk_options`.
+    `file_type` is 'files', 'dirs' or 'all'.
+    """
+    ignore_directories, ignore_files = file_type == 'files', file_type == 'dirs'
+    if git_ignore and not walk:
+        gs = GitIndexSource(dirs, ignore_directories=ignore_directories,
+                ignore_files=ignore_files, untracked=untracked, base=base)
+        try:
+            return gs.stream(), None
+        except GitIndexError:
+            pass
+
+    ds = DirectorySource(dirs, ignore_directories=ignore_directories, ignore_files=ignore_files,
+            git_ignore=git_ignore, base=base, **walk_options)
+    return ds.stream(), ds.updates if walk_options.get('watch') else None
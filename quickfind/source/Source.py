@@ -3,4 +3,8 @@ class Source(object):
     def fetch(self):
         raise NotImplementedError()
 
+    def stream(self):
+        "Yields items as they become available"
+        return iter(self.fetch())
+
 
@@ -20,7 +20,7 @@ def truncate_middle(line, length=70):
 
     reduce_amt += 3 # for the ellipsis
 
-    start = (len(line) / 2) - (reduce_amt / 2)
+    start = (len(line) // 2) - (reduce_amt // 2)
     end = start + reduce_amt
     return "%s...%s" % (line[:start], line[end:])
 
@@ -43,9 +43,33 @@ def highlight(v, query, color="green"):
 
     return [v]
 
+def no_weight(item):
+    return 0
+
+def line_part(item):
+    "The text of an (index, line) item read from a stream"
+    return item[1]
+
+class RankerFactory(object):
+    """
+    Builds Rankers of a given class with some attributes filled in.  Unlike
+    a class made on the fly, it pickles, so it can be sent to workers.
+    """
+
+    def __init__(self, cls, **attrs):
+        self.cls = cls
+        self.attrs = attrs
+
+    def __call__(self, query):
+        ranker = self.cls(query)
+        ranker.__dict__.update(self.attrs)
+        return ranker
+
 class StringRanker(Ranker):
 
     weight_f = None
+    keyed = True
+    incremental = True
 
     def __init__(self, query):
         self.qs = query.lower()
@@ -54,10 +78,28 @@ class StringRanker(Ranker):
         else:
             self.qs = [ self.qs ]
 
-    def get_parts(self, item):
+        # With several terms, the longest is looked for first: it matches
+        # the fewest keys, so most keys are turned away on the first test
+        self.checks = sorted(self.qs, key=len, reverse=True) if len(self.qs) > 1 else ()
+
+    @property
+    def terms(self):
+        return self.qs
+
+    def get_part(self, item):
         raise NotImplementedError()
 
-    def rank_part(self, q, part):
+    def key(self, item):
+        part = self.get_part(item)
+        lowered = part.lower()
+
+        # Parts already in lower case are shared rather than copied
+        return part if lowered == part else lowered
+
+    def weight(self, item):
+        return 0.0 if self.weight_f is None else self.weight_f(item)
+
+    def rank_term(self, q, part):
         if q not in part:
             return None
 
@@ -72,27 +114,50 @@ class StringRanker(Ranker):
         score -= 1.0 if part.endswith(q) else 0.0
         return score
 
-    def rank(self, item):
-        part = self.get_part(item).lower()
+    def rank_key(self, part, weight):
+        for q in self.checks:
+            if q not in part:
+                return None
 
         agg_score = 0.0
         for q in self.qs:
 
-            score = self.rank_part(q, part)
+            score = self.rank_term(q, part)
             if score is None:
                 return None
 
             agg_score += score
 
-        if self.weight_f is not None:
-            agg_score += self.weight_f(item)
+        return agg_score + weight
+
+    def rank_terms(self, part):
+        for q in self.checks:
+            if q not in part:
+                return None
+
+        # Summed in the same order as rank_key, so the scores match to the bit
+        qs = self.qs
+        agg_score = 0.0
+        for q in qs[:-1]:
+            agg_score += self.rank_term(q, part)
+
+        score = self.rank_term(qs[-1], part)
+        if score is None:
+            return None
 
-        return agg_score
+        return agg_score, score
+
+    def rank(self, item):
+        return self.rank_key(self.key(item), self.weight(item))
 
     @staticmethod
-    def new(weight_f=lambda *x: 0, **kwargs):
+    def new(weight_f=no_weight, **kwargs):
+        """
+        `get_part` and `weight_f` are plain functions of the item; they must
+        be defined at module level for the ranker to reach worker processes.
+        """
         kwargs['weight_f'] = weight_f
-        return type('StringRanker', (StringRanker,), kwargs)
+        return RankerFactory(StringRanker, **kwargs)
 
 def simpleFormatter(item, query, dims):
     v = truncate_middle(item, dims[0])
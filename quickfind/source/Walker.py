@@ -0,0 +1,97 @@
+import os, time, heapq
+from multiprocessing.pool import ThreadPool
+
+from quickfind import Trace
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+def listdir(path):
+    "Splits a directory into (dirs, symlinked dirs, files), much like os.walk"
+    start = time.time()
+    dirs, links, files = [], [], []
+    scandir = getattr(os, 'scandir', None)
+    if scandir is not None:
+        # d_type usually answers is_dir() without a stat
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+                if entry.is_symlink():
+                    links.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if os.path.isdir(full):
+                dirs.append(name)
+                if os.path.islink(full):
+                    links.append(name)
+            else:
+                files.append(name)
+
+    if Trace.tracer is not None:
+        Trace.tracer.tally('walk.listdir', time.time() - start)
+
+    return dirs, links, files
+
+def walk(roots, scan, expand, threads=8):
+    """
+    Walks a tree on a pool of threads.  `scan(node)` runs on the pool and
+    does the blocking work for a single directory; `expand(node, result)`
+    runs on the calling thread and returns the (items, child nodes) for it.
+    Directories are scanned in whatever order the pool gets to them, but
+    their items are yielded in tree order, each directory before its
+    children, so runs over the same tree give the same items in the same
+    order.  A scan that raises OSError is treated as an empty directory;
+    anything else it raises is raised out of the walk.
+    """
+    done = Queue()
+
+    def run(key, node):
+        try:
+            return key, node, scan(node), None
+        except OSError:
+            return key, node, None, None
+        except Exception as e:
+            return key, node, None, e
+
+    # A node's key is its parent's key plus its position among its
+    # siblings, so keys sort in tree order and every node still to come
+    # sorts after some node that is still running
+    running, finished, ready = [], set(), []
+
+    pool = ThreadPool(threads)
+
+    def submit(key, node):
+        heapq.heappush(running, key)
+        pool.apply_async(run, (key, node), callback=done.put)
+
+    try:
+        for i, node in enumerate(roots):
+            submit((i,), node)
+
+        while running:
+            key, node, result, error = done.get()
+            if error is not None:
+                raise error
+
+            finished.add(key)
+            if result is not None:
+                items, children = expand(node, result)
+                for i, child in enumerate(children):
+                    submit(key + (i,), child)
+
+                heapq.heappush(ready, (key, items))
+
+            while running and running[0] in finished:
+                finished.remove(heapq.heappop(running))
+
+            # Nothing still to come can sort before these
+            while ready and (not running or ready[0][0] < running[0]):
+                for item in heapq.heappop(ready)[1]:
+                    yield item
+    finally:
+        pool.terminate()
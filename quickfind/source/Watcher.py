@@ -0,0 +1,156 @@
+import os, sys, time, errno, struct, ctypes, ctypes.util
+
+from .DirectoryIndex import get_mtime
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_NONBLOCK = os.O_NONBLOCK
+
+# Entries coming and going, and .gitignore files being written
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CLOSE_WRITE | IN_MODIFY | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')
+
+fsencode = getattr(os, 'fsencode', lambda path: path)
+
+class InotifyWatcher(object):
+    """
+    Watches directories with Linux inotify, through ctypes.  changed()
+    never blocks; it returns the directories whose entries changed and
+    those whose .gitignore was written since the last call.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch = libc.inotify_rm_watch
+        self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.paths = {}
+        self.wds = {}
+
+    def add(self, path):
+        wd = self.add_watch(self.fd, fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(err, "inotify_add_watch failed for %s" % path)
+
+        # A moved directory keeps its watch; forget the old path
+        old = self.wds.get(wd)
+        if old is not None and old != path:
+            self.paths.pop(old, None)
+
+        self.paths[path] = wd
+        self.wds[wd] = path
+
+    def remove(self, path):
+        wd = self.paths.pop(path, None)
+        if wd is not None and self.wds.get(wd) == path:
+            del self.wds[wd]
+            self.rm_watch(self.fd, wd)
+
+    def changed(self):
+        "(dirs, dirs with a new .gitignore), or None if events were lost"
+        dirs, ignores = set(), set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, size = EVENT.unpack_from(buf, offset)
+                name = buf[offset + EVENT.size:offset + EVENT.size + size].rstrip(b'\0')
+                offset += EVENT.size + size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+
+                path = self.wds.get(wd)
+                if path is None or mask & IN_IGNORED:
+                    continue
+
+                if name == b'.gitignore':
+                    ignores.add(path)
+
+                # Writes to other files don't change the listing
+                if mask & (IN_CLOSE_WRITE | IN_MODIFY) and name != b'.gitignore':
+                    continue
+
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The parent sees the same change
+                    path = os.path.dirname(path)
+
+                dirs.add(path)
+
+        return dirs, ignores
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Watches directories by checking their mtimes, and those of their
+    .gitignore files, at most every `interval` seconds.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.last = time.time()
+        self.stamps = {}
+
+    def stamp(self, path):
+        return get_mtime(path), get_mtime(os.path.join(path, '.gitignore'))
+
+    def add(self, path):
+        self.stamps[path] = self.stamp(path)
+
+    def remove(self, path):
+        self.stamps.pop(path, None)
+
+    def changed(self):
+        dirs, ignores = set(), set()
+        if time.time() - self.last < self.interval:
+            return dirs, ignores
+
+        for path, (mtime, gi_mtime) in list(self.stamps.items()):
+            stamp = self.stamps[path] = self.stamp(path)
+            if stamp[0] != mtime:
+                dirs.add(path)
+            if stamp[1] != gi_mtime:
+                ignores.add(path)
+
+        self.last = time.time()
+        return dirs, ignores
+
+    def close(self):
+        pass
+
+def new_watcher():
+    "inotify where the platform has it, polling otherwise"
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher()
@@ -11,10 +11,6 @@ setup(name='quickfind',
       scripts=['qf'],
       author='Andrew Stanton',
       author_email='Andrew Stanton',
-      extras_require={
-          "ctags": 'python-ctags',
-          "fsnix": 'fsnix==0.2'
-      },
       classifiers=[
        "License :: OSI Approved :: Apache Software License",
        "Programming Language :: Python :: 2.7",
@@ -0,0 +1,50 @@
+"""
+Checks files listed from the git index against the work tree.
+"""
+import os, shutil, tempfile, subprocess, unittest
+
+from quickfind.source.GitIndexSource import GitIndexSource
+
+def has_git():
+    try:
+        return subprocess.call(['git', '--version'], stdout=subprocess.PIPE) == 0
+    except OSError:
+        return False
+
+@unittest.skipUnless(has_git(), "needs git")
+class DeletedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ('a.txt', 'b.txt', os.path.join('d', 'c.txt')):
+            self.write(path)
+
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.git('-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-m', 'files')
+        os.remove(os.path.join(self.root, 'b.txt'))
+        self.write('new.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def git(self, *args):
+        subprocess.check_call(('git',) + args, cwd=self.root)
+
+    def listed(self, untracked):
+        source = GitIndexSource(['.'], ignore_files=False, untracked=untracked, base=self.root)
+        return [os.path.join(f.dir, f.name) for f in source.stream()]
+
+    def test_deleted_files_are_left_out(self):
+        expected = [os.path.join('.', 'a.txt'), os.path.join('.', 'd', 'c.txt')]
+        self.assertEqual(self.listed(False), expected)
+        self.assertEqual(self.listed(True), expected + [os.path.join('.', 'new.txt')])
+
+if __name__ == '__main__':
+    unittest.main()
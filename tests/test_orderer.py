@@ -0,0 +1,161 @@
+"""
+Checks the orderers against ranking every item by brute force.
+"""
+import random, functools, unittest
+
+from quickfind.Orderer import STOrderer, MTOrderer, AdaptiveOrderer, GrowingOrderer, \
+        auto_select
+from quickfind.VectorOrderer import VectorOrderer
+from quickfind.source.Util import StringRanker, line_part
+
+ranker = StringRanker.new(get_part=line_part)
+
+def lines(texts):
+    "(index, line) items, as read from a stream"
+    return list(enumerate(texts))
+
+def corpus(n=40000, seed=7):
+    """
+    Paths whose first 25000 are all under src/, so a query for it leaves
+    most of the survivors in the first workers' blocks
+    """
+    rnd = random.Random(seed)
+    words = ['util', 'test', 'core', 'main', 'parse', 'index', 'render', 'a', 'b', 'c']
+    return lines('%s/%s/%s_%s%d.py' % ('src' if i < 25000 else 'lib', rnd.choice(words),
+        rnd.choice(words), rnd.choice(words), rnd.randrange(100)) for i in range(n))
+
+# Typed as in the UI: '\t' starts another term and '\b' is a backspace
+SCRIPTS = [
+    'src\tutil\bl\tte',
+    'ut\tsrc/\tpy',
+    'a\tb\tc\b\b\b\bpar',
+    'zzq\b\b\bsrc_',
+    'core\t\tmain\t',
+]
+
+def typed(script):
+    "The query after each keystroke, or None for a backspace"
+    query = ''
+    for c in script:
+        if c == '\b':
+            query = query[:-1]
+            yield None
+        else:
+            query += c
+            yield query
+
+def brute_force(items, query):
+    "The items matching `query`, best first and ties in item order"
+    rank = ranker(query)
+    scored = ((rank.rank(item), i) for i, item in enumerate(items))
+    return [items[i] for _, i in sorted((s, i) for s, i in scored if s is not None)]
+
+class OrdererCase(unittest.TestCase):
+    items = []
+
+    # brute_force over `items` by query, shared by the class's tests
+    expected = None
+
+    def brute_force(self, items, query):
+        if items is not self.items or self.expected is None:
+            return brute_force(items, query)
+
+        if query not in self.expected:
+            self.expected[query] = brute_force(items, query)
+
+        return self.expected[query]
+
+    def assertRanks(self, orderer, items, query, N=None):
+        "The top N survivors of the orderer's current level, or all of them"
+        expected = self.brute_force(items, query)
+        self.assertEqual(orderer.item_count(), len(expected))
+        if N is None:
+            N = len(expected) + 1
+        self.assertEqual(orderer.top_items(N), expected[:N])
+
+    def assertTypes(self, orderer, items):
+        "Types each script, checking the orderer after every keystroke"
+        try:
+            for script in SCRIPTS:
+                queries = []
+                for query in typed(script):
+                    if query is None:
+                        orderer.pop_query()
+                        queries.pop()
+                    else:
+                        orderer.push_query(query)
+                        queries.append(query)
+
+                    if queries:
+                        self.assertRanks(orderer, items, queries[-1], 200)
+                    else:
+                        self.assertEqual(orderer.item_count(), len(items))
+
+                for _ in queries:
+                    orderer.pop_query()
+        finally:
+            orderer.cleanup()
+
+class TypingTest(OrdererCase):
+    items = corpus()
+    expected = {}
+
+    def test_st(self):
+        self.assertTypes(STOrderer(ranker, self.items), self.items)
+
+    def test_st_index(self):
+        self.assertTypes(STOrderer(ranker, self.items, index=True), self.items)
+
+    def test_mt_index(self):
+        self.assertTypes(MTOrderer(ranker, self.items, 4, index=True), self.items)
+
+    def test_adaptive(self):
+        self.assertTypes(AdaptiveOrderer(ranker, self.items, 4, threshold=5000), self.items)
+
+    @unittest.skipUnless(VectorOrderer.supports(ranker), "needs NumPy")
+    def test_vector(self):
+        self.assertTypes(VectorOrderer(ranker, self.items), self.items)
+
+    def test_growing(self):
+        # Items arrive in batches under a query, and move to workers midway
+        build = functools.partial(auto_select, N=10000, procs=4, index=True)
+        orderer = GrowingOrderer(ranker, build, threshold=10000, index=True)
+        orderer.push_query('src\tut')
+        for start in range(0, len(self.items), 3000):
+            orderer.extend(self.items[start:start + 3000])
+            self.assertRanks(orderer, self.items[:start + 3000], 'src\tut', 200)
+
+        self.assertTrue(orderer.grown)
+        orderer.pop_query()
+        self.assertTypes(orderer, self.items)
+
+class RebalanceTest(OrdererCase):
+
+    # All of the first block matches 'zzz', so pushing it spreads that
+    # block's survivors over the other workers
+    items = lines(['zzztest%d' % i for i in range(30000)] +
+            ['other%d' % i for i in range(30000)])
+
+    def narrow(self, orderer):
+        try:
+            for query in ('zzz', 'zzztest1', 'zzztest12'):
+                orderer.push_query(query)
+                self.assertRanks(orderer, self.items, query)
+        finally:
+            orderer.cleanup()
+
+    def test_index_after_rebalance(self):
+        orderer = MTOrderer(ranker, self.items, 4, index=True)
+        orderer.push_query('zzz')
+        self.assertEqual(orderer._counts(), [7500] * 4)
+        orderer.pop_query()
+        self.narrow(orderer)
+
+    def test_adaptive_index_after_rebalance(self):
+        self.narrow(AdaptiveOrderer(ranker, self.items, 4, threshold=0, index=True))
+
+    def test_single_process_matches(self):
+        self.narrow(STOrderer(ranker, self.items, index=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Checks how a server holds on to the indexes it serves.
+"""
+import os, time, shutil, tempfile, unittest
+
+from quickfind.Server import Server, ServedIndex
+
+class SmallServer(Server):
+    MAX_INDEXES = 2
+
+class EvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.dirs = []
+        for n in range(3):
+            d = os.path.join(self.base, 'd%d' % n)
+            os.makedirs(d)
+            open(os.path.join(d, 'f.txt'), 'w').close()
+            self.dirs.append(d)
+
+        self.watch_interval = ServedIndex.WATCH_INTERVAL
+        ServedIndex.WATCH_INTERVAL = 0.05
+        self.server = SmallServer(os.path.join(self.base, 'sock'), {'procs': 2})
+
+    def tearDown(self):
+        ServedIndex.WATCH_INTERVAL = self.watch_interval
+        self.server.server_close()
+        shutil.rmtree(self.base)
+
+    def open(self, d):
+        # Walked and watched, as `qf -w` would ask for
+        return self.server.open('dir', [d, '.', 'files', False, False, False, True])
+
+    def test_least_recently_used_is_dropped(self):
+        indexes = []
+        for d in self.dirs:
+            index = self.open(d)
+            self.assertTrue(index.watched)
+            index.used -= 10 - len(indexes)
+            index.lock.release()
+            indexes.append(index)
+
+        self.assertEqual(len(self.server.indexes), 2)
+        self.assertEqual([i.stopped.is_set() for i in indexes], [True, False, False])
+        self.assertIsNone(indexes[0].orderer)
+
+    def test_idle_are_dropped_unless_in_use(self):
+        idle, busy = self.open(self.dirs[0]), self.open(self.dirs[1])
+        idle.lock.release()
+        idle.used = busy.used = time.time() - self.server.IDLE_SECONDS - 1
+        with self.server.indexes_lock:
+            self.server.evict()
+
+        self.assertEqual(list(self.server.indexes.values()), [busy])
+        self.assertTrue(idle.stopped.is_set())
+        self.assertEqual(busy.orderer.total_count(), 1)
+        busy.lock.release()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Replays recorded sessions through the search UI without a terminal.
+"""
+import os, sys, json, signal, tempfile, threading, subprocess, functools, unittest
+
+from quickfind import Session
+from quickfind.Orderer import STOrderer, GrowingOrderer, auto_select
+from quickfind.source.Util import simpleFormatter
+
+from test_orderer import ranker, corpus, brute_force
+
+ENTER = 13
+
+def session(typed, query=''):
+    "A session that types `typed` and then selects the highlighted item"
+    keys = [ord(c) if c != '\b' else 127 for c in typed] + [ENTER]
+    return {'version': 1, 'query': query, 'cols': 80, 'rows': 24,
+            'keys': [[0.0, key] for key in keys]}
+
+def printf(item, query, dims):
+    return simpleFormatter(item[1], query, dims)
+
+class ReplayTest(unittest.TestCase):
+    items = corpus(20000)
+
+    def test_selects_the_top_item(self):
+        typed = 'src\tutil\bl\tte'
+        query = 'src\tutil\tte'
+        printer, selections = Session.replay(session(typed), STOrderer(ranker, self.items),
+                printf=printf, speed=None, keep=True)
+
+        expected = brute_force(self.items, query)
+        self.assertEqual(selections, expected[:1])
+        self.assertEqual(printer.summary()['rendered'], len(typed))
+
+        last = printer.frames[-1]
+        self.assertEqual(last['count'], (len(expected), len(self.items)))
+        self.assertEqual(last['lines'][0], '$ ' + query)
+        shown = last['lines'][1:]
+        self.assertTrue(shown)
+        self.assertEqual(shown,
+                [Session.plain(printf(item, query, (80, 24))) for item in expected[:len(shown)]])
+
+    def test_items_fed_while_typing(self):
+        typed = 'ut\tsrc/\tpy'
+        build = functools.partial(auto_select, N=5000, procs=4)
+        orderer = GrowingOrderer(ranker, build, threshold=5000)
+        printer, selections = Session.replay(session(typed), orderer, feed=iter(self.items),
+                speed=None)
+
+        # Typing may beat the feed, but whatever was selected matched
+        self.assertEqual(len(selections), 1)
+        self.assertIsNotNone(ranker(typed).rank(selections[0]))
+        self.assertEqual(printer.summary()['rendered'], len(typed))
+
+class CommandLineTest(unittest.TestCase):
+    qf = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'qf')
+
+    def test_replay_over_a_pipe(self):
+        # Enough input for the workers to start while it's still being read
+        data = ''.join('line%d\n' % i for i in range(200000)).encode('utf-8')
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session('line1999'), f)
+
+            # In a group of its own, so a hung run's workers go down with it
+            proc = subprocess.Popen([sys.executable, self.qf, '--replay', path,
+                '--replay-speed', '0'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                preexec_fn=os.setsid)
+            timer = threading.Timer(60, os.killpg, (proc.pid, signal.SIGKILL))
+            timer.start()
+            try:
+                out, _ = proc.communicate(data)
+            finally:
+                timer.cancel()
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(proc.returncode, 0)
+        summary = json.loads(out.decode('utf-8'))
+        self.assertEqual(summary['rendered'], len('line1999'))
+
+if __name__ == '__main__':
+    unittest.main()